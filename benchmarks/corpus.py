@@ -0,0 +1,125 @@
+"""Deterministic synthetic Python corpora for benchmarks.
+
+    python benchmarks/corpus.py OUTPUT_DIR [--files N] [--functions N] ...
+
+Functions are sequences of random statements. A share of them (the clone
+density) are copies of earlier functions with identifiers renamed and some
+statements replaced. A share of all statements (the bucket skew) is drawn
+from a handful of common statements, which makes a few hash buckets large.
+The same arguments always give the same files.
+"""
+from __future__ import annotations
+import argparse
+import random
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+COMMON_STATEMENTS = [
+    "result = None",
+    "index += 1",
+    "self.value = value",
+    "return result",
+    "logger.debug(message)",
+]
+NAMES = [f"{e}_{i}" for e in ("item", "value", "count", "total", "node", "data") for i in range(4)]
+OPERATORS = ["+", "-", "*", "//", "%"]
+NAME = re.compile(r"\b[a-z]+_\d\b")
+
+
+@dataclass(frozen=True)
+class CorpusSpec:
+    files: int = 20
+    functions: int = 10  # per file
+    statements: int = 12  # per function, the length of statement sequences
+    clone_density: float = 0.3  # share of functions copied from earlier ones
+    mutation_rate: float = 0.1  # share of statements replaced in a copy
+    bucket_skew: float = 0.2  # share of statements drawn from COMMON_STATEMENTS
+    seed: int = 0
+
+
+class CorpusGenerator:
+    def __init__(self, spec: CorpusSpec):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self.functions = []  # generated functions, as lists of statement lines
+
+    def expression(self, depth: int = 0) -> str:
+        rng = self.rng
+        kind = rng.randrange(4 if depth < 2 else 2)
+        if kind == 0:
+            return rng.choice(NAMES)
+        if kind == 1:
+            return str(rng.randrange(100))
+        if kind == 2:
+            return f"({self.expression(depth + 1)} {rng.choice(OPERATORS)} {self.expression(depth + 1)})"
+        args = ", ".join(self.expression(depth + 1) for _ in range(rng.randrange(3)))
+        return f"{rng.choice(NAMES)}({args})"
+
+    def statement(self) -> list[str]:
+        rng = self.rng
+        if rng.random() < self.spec.bucket_skew:
+            return [rng.choice(COMMON_STATEMENTS)]
+        kind = rng.randrange(5)
+        target = rng.choice(NAMES)
+        if kind == 0:
+            return [f"if {self.expression()} > {self.expression()}:", f"    {target} = {self.expression()}"]
+        if kind == 1:
+            return [f"for {target} in range({self.expression()}):", f"    total += {self.expression()}"]
+        if kind == 2:
+            return [f"{target} = [{self.expression()} for {target} in {rng.choice(NAMES)}]"]
+        return [f"{target} = {self.expression()}"]
+
+    def function(self, name: str) -> list[str]:
+        spec = self.spec
+        rng = self.rng
+        if self.functions and rng.random() < spec.clone_density:
+            original = rng.choice(self.functions)
+            renames = dict(zip(NAMES, rng.sample(NAMES, len(NAMES))))
+            body = []
+            for statement in original:
+                if rng.random() < spec.mutation_rate:
+                    body.append(self.statement())
+                else:
+                    body.append([_rename(line, renames) for line in statement])
+        else:
+            body = [self.statement() for _ in range(spec.statements)]
+        self.functions.append(body)
+        return [f"def {name}(self, value, message):"] + [
+            "    " + line for statement in body for line in statement
+        ]
+
+    def write(self, directory: Path) -> list[Path]:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for i in range(self.spec.files):
+            lines = []
+            for j in range(self.spec.functions):
+                lines += self.function(f"function_{i}_{j}") + [""]
+            path = directory / f"module_{i}.py"
+            path.write_text("\n".join(lines))
+            paths.append(path)
+        return paths
+
+
+def _rename(line: str, renames: dict) -> str:
+    return NAME.sub(lambda m: renames.get(m[0], m[0]), line)
+
+
+def generate_corpus(directory: Path, spec: CorpusSpec = CorpusSpec()) -> list[Path]:
+    return CorpusGenerator(spec).write(directory)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("output", type=Path)
+    for name, value in vars(CorpusSpec()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    options = vars(parser.parse_args())
+    paths = generate_corpus(options.pop("output"), CorpusSpec(**options))
+    print(f"{len(paths)} files written")
+
+
+if __name__ == "__main__":
+    cli()
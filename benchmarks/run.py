@@ -0,0 +1,192 @@
+"""Time each phase of clone detection on synthetic corpora of growing size.
+
+    python benchmarks/run.py [--scales 1,2,4] [--files N] [--memory] [--output results.jsonl]
+        [--baseline benchmarks/baseline.json] [--threshold 0.25] [--write-baseline]
+
+For every scale a corpus of scale * files files is generated and the
+phases are run one after another, as clone_detection_algorithm.main runs
+them: parsing, sizing, hashing, marking (build_unifiers and clusterize, or
+hash marks), find_sequences, refinement, dominance removal, distances and
+coverage, and report writing. Phases are timed by Instrumentation. One JSON
+record per scale is printed and appended to --output, which gives scaling
+curves. With --memory the peak of traced allocations is recorded for each
+phase, which slows every phase down.
+
+Records are compared to the baseline for the same corpus and settings: the
+counts have to be equal, and the total time may be over the baseline by at
+most --threshold, a fraction, unless --memory is given. The exit status is
+1 otherwise. Timings of the baseline are those of the machine that wrote
+it, --write-baseline writes it again from this run.
+"""
+from __future__ import annotations
+import argparse
+import dataclasses
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from corpus import CorpusSpec, generate_corpus  # noqa: E402
+
+from clonedigger.backend import clone_detection_algorithm as cda  # noqa: E402
+from clonedigger.backend.line_coverage import LineCoverage  # noqa: E402
+from clonedigger.instrumentation import Instrumentation, max_rss_mb  # noqa: E402
+from clonedigger.main import parse_files  # noqa: E402
+from clonedigger.report.html_report import HTMLReport  # noqa: E402
+from clonedigger.settings import Settings  # noqa: E402
+
+BASELINE = Path(__file__).parent / "baseline.json"
+COUNTS = ["statements", "hash_buckets", "largest_bucket", "candidates", "clones", "covered_lines"]
+
+
+def run_phases(fps: list[Path], cfg: Settings, instrumentation: Instrumentation, output: Path):
+    cda.unification_cache.clear(cfg.unification_cache_size)
+    with instrumentation.phase("parse"):
+        source_files = parse_files(fps, [], jobs=cfg.jobs, cfg=cfg)
+    cda.reset_canonical_ids(source_files)
+    sequences = [s for source_file in source_files for s in source_file.statement_sequences]
+    with instrumentation.phase("sizes"):
+        cda.calc_statement_sizes(sequences, cfg)
+        cda.assign_canonical_ids(sequences)
+    with instrumentation.phase("hashes"):
+        hash_to_statement = cda.build_hash_to_statement(
+            sequences, cfg, dcup_hash=not cfg.clusterize_using_hash
+        )
+    if cfg.clusterize_using_dcup or cfg.clusterize_using_hash:
+        with instrumentation.phase("mark_using_hash"):
+            cda.mark_using_hash(hash_to_statement, cfg)
+    else:
+        with instrumentation.phase("build_unifiers"):
+            clusters_map = cda.build_unifiers(hash_to_statement, cfg)
+        with instrumentation.phase("clusterize"):
+            cda.clusterize(hash_to_statement, clusters_map, cfg)
+    if not cfg.force:
+        sequences = cda.filter_long_sequences(sequences)
+    with instrumentation.phase("find_sequences"):
+        candidates = list(cda.find_sequences(sequences, cfg))
+    with instrumentation.phase("refine"):
+        clones = cda.refine_duplicate_candidates(candidates, cfg)
+    with instrumentation.phase("remove_dominated_clones"):
+        clones = cda.remove_dominated_clones(clones)
+    with instrumentation.phase("distances_and_coverage"):
+        for clone in clones:
+            clone.storeDistances()
+        source_lines = LineCoverage()
+        for sequence in sequences:
+            source_lines.add(sequence)
+        covered_source_lines = LineCoverage()
+        for clone in clones:
+            for sequence in clone:
+                covered_source_lines.add(sequence)
+    with instrumentation.phase("report"):
+        report = HTMLReport()
+        report.clones = clones
+        report.file_names = fps
+        report.all_source_lines_count = len(source_lines)
+        report.covered_source_lines_count = len(covered_source_lines)
+        report.sort()
+        report.writeReport(output, cfg)
+    return dict(
+        statements=sum(map(len, sequences)),
+        hash_buckets=len(hash_to_statement),
+        largest_bucket=max(map(len, hash_to_statement.values()), default=0),
+        candidates=len(candidates),
+        clones=len(clones),
+        covered_lines=len(covered_source_lines),
+    )
+
+
+def regressions(record: dict, baseline: dict, threshold: float = None) -> list[str]:
+    """Differences of record from the baseline of its scale, timings unless threshold is None."""
+    r = [
+        f"{name}: {record[name]}, {baseline[name]} in the baseline"
+        for name in COUNTS
+        if record[name] != baseline[name]
+    ]
+    slower = threshold is not None and (
+        record["total_seconds"] > baseline["total_seconds"] * (1 + threshold)
+    )
+    if slower:
+        r.append(
+            f"total_seconds: {record['total_seconds']}, over {baseline['total_seconds']} "
+            f"in the baseline by more than {threshold:.0%}"
+        )
+    return r
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--scales", default="1,2,4", help="corpus sizes, in multiples of --files")
+    parser.add_argument("--memory", action="store_true", help="trace peak memory of each phase")
+    parser.add_argument("--output", type=Path, help="append the records to this JSON Lines file")
+    parser.add_argument("--settings", default="{}", help="Settings fields as a JSON object")
+    parser.add_argument("--baseline", type=Path, default=BASELINE, help="records to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25, help="slowdown allowed")
+    parser.add_argument("--write-baseline", action="store_true", help="replace the baseline")
+    for name, value in vars(CorpusSpec()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    options = parser.parse_args()
+    spec = CorpusSpec(**{e.name: getattr(options, e.name) for e in dataclasses.fields(CorpusSpec)})
+    settings = json.loads(options.settings)
+    cfg = Settings(**{"logger_level": 30, **settings})
+    baseline = {}
+    if options.baseline.exists() and not options.write_baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline["corpus"] != dataclasses.asdict(spec) or baseline["settings"] != settings:
+            print(f"{options.baseline} is for another corpus or settings", file=sys.stderr)
+            baseline = {}
+    records = []
+    failed = False
+    for scale in map(int, options.scales.split(",")):
+        scaled = dataclasses.replace(spec, files=spec.files * scale)
+        with tempfile.TemporaryDirectory() as directory, Instrumentation(
+            trace_memory=options.memory
+        ) as instrumentation:
+            fps = generate_corpus(Path(directory) / "corpus", scaled)
+            counts = run_phases(fps, cfg, instrumentation, Path(directory) / "output.html")
+        record = dict(
+            scale=scale,
+            corpus=dataclasses.asdict(scaled),
+            settings=settings,
+            **counts,
+            phases={
+                e["name"]: {k: e[k] for k in ("seconds", "peak_memory_mb") if k in e}
+                for e in instrumentation.phases
+            },
+            total_seconds=round(instrumentation.total_time(), 4),
+            max_rss_mb=max_rss_mb(),
+        )
+        records.append(record)
+        print(json.dumps(record))
+        if options.output:
+            with open(options.output, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if str(scale) in baseline.get("scales", {}):
+            # traced allocations slow every phase down
+            threshold = None if options.memory else options.threshold
+            for message in regressions(record, baseline["scales"][str(scale)], threshold):
+                print(f"scale {scale}: {message}", file=sys.stderr)
+                failed = True
+    if options.write_baseline:
+        with open(options.baseline, "w") as f:
+            json.dump(
+                dict(
+                    corpus=dataclasses.asdict(spec),
+                    settings=settings,
+                    scales={
+                        str(e["scale"]): {k: e[k] for k in [*COUNTS, "total_seconds"]}
+                        for e in records
+                    },
+                ),
+                f,
+                indent=2,
+            )
+            f.write("\n")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,90 @@
+"""Time the start of the command line tool and check it against a budget.
+
+    python benchmarks/startup.py [--runs 5] [--files 3] [--budget-ms 150] [--output results.jsonl]
+
+Every run starts a fresh interpreter, as a pre-commit hook does. The import
+time of the package is read from `python -X importtime`, then the
+whole tool is run on a small synthetic corpus for each report format.
+Medians are printed as one JSON record, together with the heavy modules
+that a run on a few files should not import. The exit status is 1 when
+the median import time is over --budget-ms.
+"""
+from __future__ import annotations
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from corpus import CorpusSpec, generate_corpus  # noqa: E402
+
+# not needed to check a few files with the default settings
+HEAVY_MODULES = ["pydantic", "jinja2", "sqlite3", "concurrent.futures.process"]
+
+
+def import_time_ms() -> float:
+    """Import time of the modules a run imports before parsing, in a fresh interpreter."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import clonedigger.__main__, clonedigger.main"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    total = 0
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, name = line.split(":", 1)[1].split("|")
+        # modules imported by others are in the cumulative time of a top level one
+        if name.startswith(" clonedigger") and not name.startswith("  "):
+            total += int(cumulative)
+    return total / 1000
+
+
+def imported_modules(code: str) -> list[str]:
+    """HEAVY_MODULES imported by running code in a fresh interpreter."""
+    check = f"{code}\nimport sys\nprint(' '.join(e for e in {HEAVY_MODULES!r} if e in sys.modules))"
+    return subprocess.run(
+        [sys.executable, "-c", check], capture_output=True, text=True, check=True
+    ).stdout.split()
+
+
+def run_ms(fps: list[Path], output: Path, output_format: str) -> float:
+    args = ["-m", "clonedigger", "--format", output_format, "-o", str(output)]
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, *args, *map(str, fps)], capture_output=True, check=True)
+    return (time.perf_counter() - t0) * 1000
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--runs", type=int, default=5, help="interpreters started per measure")
+    parser.add_argument("--files", type=int, default=3, help="files of the corpus")
+    parser.add_argument("--budget-ms", type=float, default=150, help="median import time allowed")
+    parser.add_argument("--output", type=Path, help="append the record to this JSON Lines file")
+    options = parser.parse_args()
+
+    record = dict(
+        import_ms=round(statistics.median(import_time_ms() for _ in range(options.runs)), 1)
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        fps = generate_corpus(Path(directory) / "corpus", CorpusSpec(files=options.files))
+        for output_format in ["jsonl", "html"]:
+            output = Path(directory) / f"output.{output_format}"
+            times = [run_ms(fps, output, output_format) for _ in range(options.runs)]
+            record[f"run_{output_format}_ms"] = round(statistics.median(times), 1)
+    record["heavy_modules"] = imported_modules("import clonedigger.__main__, clonedigger.main")
+    record["budget_ms"] = options.budget_ms
+    print(json.dumps(record))
+    if options.output:
+        with open(options.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    if record["import_ms"] > options.budget_ms:
+        print(f"import time over the budget of {options.budget_ms} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
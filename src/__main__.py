@@ -1,12 +1,18 @@
+import itertools
 import sys
 from pathlib import Path
 from argparse import ArgumentParser
+from clonedigger.discovery import DEFAULT_EXCLUDES, ExcludePatterns, FileFinder, read_file_list
 from clonedigger.settings import Settings
-from clonedigger.main import main
 
 
-def cli():
-
+def cli(argv: list[str] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["query"]:
+        return query_cli(argv[1:])
+    serve = argv[:1] == ["serve"]
+    if serve:
+        argv = argv[1:]
 
     cmdline = ArgumentParser(
         usage="""To run Clone Digger type:
@@ -16,6 +22,8 @@ def cli():
         clonedigger source_file_1 source_file_2 ...
           or
         clonedigger path_to_source_tree
+          or, to keep the clones in memory and answer `clonedigger query`:
+        clonedigger serve [OPTION]... path_to_source_tree
         Don't forget to remove automatically generated sources, tests and third
         party libraries from the source tree.
 
@@ -29,8 +37,8 @@ def cli():
     kwargs = [
         dict(
             args="file_list",
-            help="files to parse",
-            nargs="+",
+            help="files and directories to parse",
+            nargs="*",
         ),
         dict(
             args="--no-recursion",
@@ -41,7 +49,13 @@ def cli():
         dict(
             args=["-o", "--output"],
             dest="output",
-            help='the name of the output file ("output.html" by default)',
+            help='the name of the output file ("output.html" by default), gzipped if it ends with .gz',
+        ),
+        dict(
+            args="--format",
+            dest="output_format",
+            choices=["html", "jsonl", "sarif"],
+            help="html (by default), JSON Lines with one clone per line, or SARIF",
         ),
         dict(
             args="--clustering-threshold",
@@ -101,8 +115,21 @@ def cli():
             args="--ignore-dir",
             action="append",
             dest="ignore_dirs",
-            help="exclude directories from parsing",
-            type=list,
+            help="exclude directories with this name from parsing, at any depth",
+        ),
+        dict(
+            args="--exclude",
+            action="append",
+            dest="excludes",
+            help="exclude files and directories matching this .gitignore style pattern, "
+            "relative to each input directory; .git, node_modules, __pycache__, virtualenvs "
+            "and the like are excluded unless a pattern like '!node_modules/' includes them",
+        ),
+        dict(
+            args="--exclude-from",
+            action="append",
+            dest="exclude_files",
+            help="read exclude patterns from a file such as .gitignore",
         ),
         dict(
             args="--report-unifiers",
@@ -116,9 +143,98 @@ def cli():
             dest="f_prefixes",
             help="skip functions/methods with these prefixes (provide a CSV string as argument)",
         ),
+        dict(
+            args=["-j", "--jobs"],
+            type=int,
+            dest="jobs",
+            help="the number of processes used to parse files (1 by default, 0 - one per CPU core)",
+        ),
+        dict(
+            args="--compact-trees",
+            action="store_true",
+            dest="compact_trees",
+            help="keep parsed files in flat arrays instead of node objects, uses much less memory",
+        ),
+        dict(
+            args="--cache-dir",
+            dest="cache_dir",
+            help="keep parsed files in this directory and reuse them for unchanged files",
+        ),
+        dict(
+            args="--cache-size",
+            type=int,
+            dest="cache_size",
+            help="the size limit of the cache directory in MB (1024 by default)",
+        ),
+        dict(
+            args="--index",
+            dest="index",
+            help="record files, statement marks and clones in this SQLite file",
+        ),
+        dict(
+            args="--incremental",
+            action="store_true",
+            dest="incremental",
+            help="analyse only files that changed since the index was written "
+            "(the index is .clonedigger.db unless --index is given)",
+        ),
+        dict(
+            args="--shard-index",
+            dest="shard_index",
+            help="scan one shard of a code base: write its clone index to this file and no report",
+        ),
+        dict(
+            args="--merge",
+            action="store_true",
+            dest="merge",
+            help="the arguments are shard indexes: report their clones and the clones across "
+            "shards (run with the same options and working directory as the shards)",
+        ),
+        dict(
+            args="--socket",
+            dest="socket",
+            help="with serve: the Unix socket to listen on (.clonedigger.sock by default)",
+        ),
+        dict(
+            args="--unification-cache-size",
+            type=int,
+            dest="unification_cache_size",
+            help="the number of unification results kept in memory (65536 by default)",
+        ),
+        dict(
+            args="--cluster-index",
+            type=int,
+            dest="cluster_index",
+            help="in hash buckets of at least this many statements, unify statements only with "
+            "clusters found similar by MinHash; faster, but may miss some clones",
+        ),
+        dict(
+            args="--memory-limit",
+            type=int,
+            dest="memory_limit",
+            help="out-of-core mode: keep parsed trees and buffers within about this many MB, "
+            "spilling to temporary files (needs hash based marks, the default)",
+        ),
+        dict(
+            args="--manifest",
+            dest="manifest",
+            help="write timings, counters and histograms of the run to this JSON file",
+        ),
+        dict(
+            args="--trace-memory",
+            action="store_true",
+            dest="trace_memory",
+            help="record the peak memory of each phase in the manifest (slow)",
+        ),
+        dict(
+            args="--profile",
+            dest="profile_dir",
+            help="profile each phase with cProfile into DIR/<phase>.prof",
+        ),
         dict(
             args="--file-list",
-            dest="file_list",
+            action="append",
+            dest="file_lists",
             help="a file that contains a list of file names that must be processed by Clone Digger",
         ),
     ]
@@ -130,7 +246,7 @@ def cli():
         cmdline.add_argument(*args, **kw)
 
     cmdline.set_defaults(**Settings().model_dump())
-    options = cmdline.parse_args()
+    options = cmdline.parse_args(argv)
 
     cfg = Settings(**{
         k: getattr(options, k) for k, v in Settings() if getattr(options, k, None) is not None
@@ -142,28 +258,64 @@ def cli():
         func_prefixes = [e.strip() for e in options.f_prefixes.split(",")]
 
     # resolve output
-    output = Path(options.output or "output.html")
-
-    # collect file paths
-    options.ignore_dirs = options.ignore_dirs or []
-    if isinstance(options.file_list, str):
-        options.file_list = [options.file_list]
-
-    fps = []
-    for fp in options.file_list:
-        fp = Path(fp)
-        if fp.is_dir():
-            if cfg.no_recursion:
-                fps += list(fp.iterdir())
-            else:
-                fps += [
-                    e
-                    for e in fp.rglob("*")
-                    if e.is_file() and e.parent.name not in options.ignore_dirs
-                ]
-        else:
-            fps.append(fp)
+    output = Path(options.output or f"output.{cfg.output_format}")
+
+    # file paths are found while files are parsed
+    if not options.file_list and not options.file_lists:
+        cmdline.error("no files to parse")
+    excludes = ExcludePatterns(DEFAULT_EXCLUDES)
+    for name in options.ignore_dirs or []:
+        excludes.add(f"{name}/")
+    for file_name in options.exclude_files or []:
+        excludes.read(file_name)
+    for pattern in options.excludes or []:
+        excludes.add(pattern)
+    inputs = itertools.chain(options.file_list, *map(read_file_list, options.file_lists or []))
+    finder = FileFinder(excludes, recursive=not cfg.no_recursion)
+    fps = finder.find(inputs)
+
+    # the detection backend is imported once the arguments are known to be valid
+    if serve:
+        from clonedigger.client import DEFAULT_SOCKET
+        from clonedigger.server import main as serve_main
+
+        socket_path = Path(options.socket or DEFAULT_SOCKET)
+        serve_main(fps, func_prefixes, cfg, socket_path=socket_path, finder=finder)
+        return
+    from clonedigger.main import main
+
     main(fps=fps, output=output, func_prefixes=func_prefixes, cfg=cfg)
 
 
-cli()
+def query_cli(argv: list[str]):
+    import json
+    import os
+    from clonedigger.client import DEFAULT_SOCKET, request
+
+    cmdline = ArgumentParser(
+        prog="clonedigger query",
+        description="Ask a server started with `clonedigger serve`, print its JSON response",
+    )
+    cmdline.add_argument(
+        "op",
+        choices=["clones", "stats", "update", "status", "shutdown"],
+        help="clones involving the paths, duplication statistics of the paths, "
+        "paths changed, the state of the server or stop it",
+    )
+    cmdline.add_argument("paths", nargs="*", help="files and directories")
+    cmdline.add_argument(
+        "--socket", default=DEFAULT_SOCKET, help="the socket of the server (.clonedigger.sock)"
+    )
+    options = cmdline.parse_args(argv)
+    message = dict(op=options.op, paths=[os.path.abspath(e) for e in options.paths])
+    try:
+        response = request(options.socket, message)
+    except OSError as e:
+        cmdline.error(f"no server on {options.socket}: {e.strerror or e}")
+    print(json.dumps(response, indent=2))
+    if "error" in response:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,23 +1,118 @@
 from __future__ import annotations
 import ast
+import functools
+import hashlib
+import mmap
+import os
+import re
+import zlib
+from array import array
 from pathlib import Path
+from clonedigger.settings import logger
+
+
+@functools.lru_cache(maxsize=4096)
+def name_hash(name: str) -> int:
+    # str hashes are salted per process, node hashes have to survive the parse cache
+    return zlib.crc32(name.encode())
+
+
+_canonical_ids: dict[tuple, int] = {}
+_canonical_ids_generation = 0  # the number of times the table was cleared
+
+
+def canonical_id(name: str, child_ids: tuple) -> int:
+    # hash consing of (name, ids of the children), ids are only valid in this process
+    return _canonical_ids.setdefault((name, child_ids), len(_canonical_ids))
+
+
+def clear_canonical_ids():
+    """Start a new table of canonical ids, ids given before mean nothing any more.
+
+    The table keeps every distinct subtree, leaves and constants included, so
+    it is cleared for each run; trees that outlive it drop their ids with
+    resetCanonicalIds.
+    """
+    global _canonical_ids_generation
+    _canonical_ids.clear()
+    _canonical_ids_generation += 1
+
+
+def canonical_id_count() -> int:
+    return len(_canonical_ids)
+
+
+def canonical_id_generation() -> int:
+    # changes when the table is cleared, ids given before then are stale
+    return _canonical_ids_generation
+
+
 class SourceFile:
+    """A file read once, only the offsets of its lines are kept in memory.
 
-    def __init__(self, file_name: Path):
-        f = open(file_name, "r", encoding="utf-8", errors="ignore")
+    Lines are sliced from a memory map of the file, opened when lines are
+    first needed and checked against the data that was parsed. At most
+    max_open maps are kept, close_all closes them after a report.
+    """
 
-        def filter_func(s):
-            for i in range(len(s) - 1, -2, -1):
-                if i < 0 or not s[i].isspace():
-                    break
-            if i >= 0:
-                return s[: i + 1]
-            else:
-                return s
+    newline = re.compile(rb"\r\n|\r|\n")
+    max_open = 256
+    # in the order they were last used, None for files changed since parsing
+    _maps: dict[SourceFile, mmap.mmap] = {}
 
-        self.source_lines = [filter_func(s) for s in f.readlines()]
-        f.close()
+    def __init__(self, file_name: Path, data: bytes = None):
+        if data is None:
+            data = Path(file_name).read_bytes()
         self.file_name = file_name
+        self.digest = hashlib.sha256(data).hexdigest()
+        self._line_offsets = array("q", [0])
+        self._line_offsets.extend(m.end() for m in self.newline.finditer(data))
+        if self._line_offsets[-1] != len(data):
+            self._line_offsets.append(len(data))
+
+    def __len__(self):
+        return len(self._line_offsets) - 1
+
+    def getLines(self, line_numbers) -> list[str]:
+        line_numbers = list(line_numbers)
+        if not line_numbers or not len(self):
+            return []
+        offsets = self._line_offsets
+        m = self._map()
+        if m is None:
+            return [""] * len(line_numbers)
+        return [
+            m[offsets[e] : offsets[e + 1]].decode("utf-8", errors="ignore").rstrip()
+            for e in line_numbers
+        ]
+
+    def _map(self) -> mmap.mmap | None:
+        maps = SourceFile._maps
+        if self in maps:
+            maps[self] = maps.pop(self)
+            return maps[self]
+        m = None
+        with open(self.file_name, "rb") as f:
+            if os.fstat(f.fileno()).st_size == self._line_offsets[-1]:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if m is not None and hashlib.sha256(m).hexdigest() != self.digest:
+            m.close()
+            m = None
+        if m is None:
+            logger.warning(f"{self.file_name} changed since it was parsed, its lines are left out")
+        if len(maps) >= self.max_open:
+            oldest = maps.pop(next(iter(maps)))
+            if oldest is not None:
+                oldest.close()
+        maps[self] = m
+        return m
+
+    @classmethod
+    def close_all(cls):
+        for m in cls._maps.values():
+            if m is not None:
+                m.close()
+        cls._maps.clear()
 
 
 class StatementSequence:
@@ -72,6 +167,8 @@ class StatementSequence:
 
 
 class TreeMixin:
+    __slots__ = ()
+
     def addChild(self, child, save_parent: bool = False):
         if not save_parent:
             child.parent = self
@@ -86,30 +183,78 @@ class TreeMixin:
 
 
 class HashMixin:
-    def getFullHash(self):
-        return self.getDCupHash(-1)
+    __slots__ = ()
 
-    def getDCupHash(self, level: int):
+    hash_depth = 3  # DCup level used by __hash__
+
+    def propagateHashes(self, depth: int):
+        """Compute DCup hashes of levels 0..depth and the full hash of every node below.
+
+        One bottom-up pass, the values are kept, so later lookups are O(1).
+        Leaves hash to 0 whatever their names are.
+        """
+        if self._dcup_hashes is not None and len(self._dcup_hashes) > depth:
+            return
+        for child in self.childs:
+            child.propagateHashes(depth)
         if len(self.childs) == 0:
-            ret = 0  # in case of names and constants
-        else:
-            ret = (level + 1) * hash(self.name) * len(self.childs)
-        # if level == -1, it will not stop until it reaches the leaves
-        if level != 0:
-            for i in range(len(self.childs)):
-                child = self.childs[i]
+            self._dcup_hashes = (0,) * (depth + 1)
+            self._full_hash = 0
+            return
+        base = name_hash(self.name) * len(self.childs)
+        dcup = [hash(base)]
+        for level in range(1, depth + 1):
+            ret = (level + 1) * base
+            for i, child in enumerate(self.childs):
                 ret += (i + 1) * child.getDCupHash(level - 1)
-        return hash(ret)
+            dcup.append(hash(ret))
+        self._dcup_hashes = tuple(dcup)
+        ret = base
+        for i, child in enumerate(self.childs):
+            ret += (i + 1) * child.getFullHash()
+        self._full_hash = hash(ret)
+
+    def getFullHash(self):
+        if self._full_hash is None:
+            self.propagateHashes(self.hash_depth)
+        return self._full_hash
+
+    def getDCupHash(self, level: int):
+        if level < 0:
+            return self.getFullHash()
+        self.propagateHashes(max(level, self.hash_depth))
+        return self._dcup_hashes[level]
+
+    def resetCanonicalIds(self):
+        """Drop the ids of the tree and its descendants, after clear_canonical_ids."""
+        stack = [self]
+        while stack:
+            tree = stack.pop()
+            tree._cid = None
+            stack.extend(tree.childs)
+
+    def getCanonicalId(self) -> int:
+        """Id shared by all structurally equal trees, assigned bottom-up and kept."""
+        if self._cid is None:
+            self._cid = canonical_id(
+                self.name, tuple(child.getCanonicalId() for child in self.childs)
+            )
+        return self._cid
 
     def __hash__(self):
-        if not self._hash:
-            self._hash = hash(self.getDCupHash(3) + hash(self.name))
+        if self._hash is None:
+            self._hash = hash(self.getDCupHash(self.hash_depth) + name_hash(self.name))
         return self._hash
 
     def __eq__(self, tree2):
         tree1 = self
         if type(tree2) == type(None):
             return False
+        if tree1 is tree2:
+            return True
+        cid1, cid2 = tree1._cid, getattr(tree2, "_cid", None)
+        if cid1 is not None and cid2 is not None:
+            return cid1 == cid2
         if tree1.name != tree2.name:
             return False
         if len(tree1.childs) != len(tree2.childs):
@@ -121,6 +266,8 @@ class HashMixin:
 
 
 class LineMixin:
+    __slots__ = ()
+
     def getCoveredLineNumbers(self):
         return self._covered_line_numbers
 
@@ -142,7 +289,7 @@ class LineMixin:
             )
         )
         source_line_numbers_list.sort()
-        return [self.source_file.source_lines[e] for e in source_line_numbers_list]
+        return self.source_file.getLines(source_line_numbers_list)
 
     def propagateCoveredLineNumbers(self):
         self._covered_line_numbers = set(self._line_numbers)
@@ -152,14 +299,13 @@ class LineMixin:
 
     def as_string(self):
         return "\n".join(
-            [
-                self.source_file.source_lines[e]
-                for e in sorted(list(self._covered_line_numbers))
-            ]
+            self.source_file.getLines(sorted(self._covered_line_numbers))
         )
 
 
 class SizeMixin:
+    __slots__ = ()
+
     def storeSize(self, free_variable_cost: float):
         observed = set()
         self._none_count = 0
@@ -230,12 +376,25 @@ class AbstractSyntaxTree(TreeMixin, HashMixin, LineMixin, SizeMixin):
         self._covered_line_numbers = None
         self.parent = None
         self._hash = None
+        self._dcup_hashes = None
+        self._full_hash = None
+        self._cid = None
+        self._size = None
+        self._none_count = 0
         self.source_file = source_file
         self._is_statement = False
         self.ast_node = None
         self.name = name or "AbstractSyntaxTree"
         self.mark = None
 
+    def __getstate__(self):
+        # ast_node is only needed while NT transforms the tree,
+        # canonical ids are not meaningful in another process
+        state = self.__dict__.copy()
+        state["ast_node"] = None
+        state["_cid"] = None
+        return state
+
 
 class FreeVariable(AbstractSyntaxTree):
     count = 0
@@ -288,6 +447,7 @@ class NT(ast.NodeTransformer):
             source_file=self._source_file,
         )
         node_prepared.ast_node = node
+        node_prepared._is_statement = isinstance(node, ast.stmt)
 
         return node_prepared
 
@@ -338,7 +498,7 @@ def get_statement_sequences(tree: AbstractSyntaxTree, size_threshold: int):
     current = StatementSequence(source_file=tree.source_file)
 
     for child in tree.childs:
-        if isinstance(child.ast_node, ast.stmt):
+        if child._is_statement:
             current.addStatement(child)
         elif not_empty(current):
             r += [current]
@@ -357,14 +517,42 @@ class ASTWrapper:
     extension = "py"
     ignored_statements = ["Import", "From", "ImportFrom"]
 
-    def __init__(self, file_name: Path, func_prefixes: tuple = ()):
-        self._source_file = SourceFile(file_name)
+    def __init__(
+        self,
+        file_name: Path,
+        func_prefixes: tuple = (),
+        data: bytes = None,
+        compact: bool = False,
+    ):
+        if data is None:
+            data = Path(file_name).read_bytes()
+        self._source_file = SourceFile(file_name, data)
         self._func_prefixes = func_prefixes
+        self.statement_sequences = None
 
-        nt = NT(
-            source_file=self._source_file,
-            ignored_statements=self.ignored_statements,
-        )
+        self.digest = self._source_file.digest
+        module = ast.parse(source=data.decode("utf-8", errors="ignore"))
+        if compact:
+            from clonedigger.backend.compact_tree import CompactTree
 
-        with open(file_name, encoding="utf-8", errors="ignore") as f:
-            self._tree = nt.visit(ast.parse(source=f.read()))
+            self._tree = CompactTree.from_ast(
+                module, self.ignored_statements, self._source_file
+            ).root()
+        else:
+            nt = NT(
+                source_file=self._source_file,
+                ignored_statements=self.ignored_statements,
+            )
+            self._tree = nt.visit(module)
+            self._tree.propagateCoveredLineNumbers()
+            self._tree.propagateHeight()
+
+    def fingerprint(self, cfg):
+        # everything here depends only on the file and cfg, so it can be cached
+        self.statement_sequences = get_statement_sequences(
+            self._tree, size_threshold=cfg.size_threshold
+        )
+        for sequence in self.statement_sequences:
+            for statement in sequence:
+                statement.storeSize(free_variable_cost=cfg.free_variable_cost)
+                statement.propagateHashes(max(cfg.hashing_depth, statement.hash_depth))
@@ -1,15 +1,23 @@
 from __future__ import annotations
 import copy
 import logging
+import math
+import os
 import sys
-import time
-from collections.abc import Callable
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
 from clonedigger.backend.ast_wrapper import (
     AbstractSyntaxTree,
     FreeVariable,
     StatementSequence,
+    clear_canonical_ids,
     get_statement_sequences,
 )
+from clonedigger.backend.cluster_index import ClusterIndex
+from clonedigger.backend.line_coverage import LineCoverage
+from clonedigger.backend.suffix_array import SuffixArray
+from clonedigger.instrumentation import Instrumentation
 from clonedigger.settings import logger
 
 
@@ -17,6 +25,9 @@ class PairSequences:
     def __init__(self, sequences: list[StatementSequence], cfg=None):
         self._sequences = sequences
         self.cfg = cfg
+        # found by detection, so that reporting does not unify again
+        self.distance = None
+        self.row_differences = None
 
     def __getitem__(self, *args):
         return self._sequences.__getitem__(*args)
@@ -28,10 +39,29 @@ class PairSequences:
         assert self[0].getWeight() == self[1].getWeight()
         return self[0].getWeight()
 
-    def calcDistance(self):
-        trees = [s.constructTree() for s in self]
-        unifier = Unifier(trees[0], trees[1], cfg=self.cfg)
-        return unifier.getSize()
+    def calcDistance(self, limit: float = math.inf):
+        """Unification cost of the two sequences, or inf once it is over limit."""
+        # the substitutions of a sequence are the union of those of its statements
+        free_variable_cost = self.cfg.free_variable_cost
+        if free_variable_cost > 1:
+            limit = math.inf  # costs of substitutions may be negative
+        pairs = {}
+        cost = 0
+        for t1, t2 in zip(self[0], self[1]):
+            for cid1, cid2, size1, size2 in unification_cache.get(t1, t2, self.cfg):
+                if (cid1, cid2) not in pairs:
+                    pairs[cid1, cid2] = size1 + size2
+                    cost += size1 + size2 - 2 * free_variable_cost
+                    if cost > limit:
+                        return math.inf
+        return sum(size - 2 * free_variable_cost for size in pairs.values())
+
+    def storeDistances(self):
+        if self.distance is None:
+            self.distance = self.calcDistance()
+        self.row_differences = [
+            unification_cache.getCost(t1, t2, self.cfg) > 0 for t1, t2 in zip(self[0], self[1])
+        ]
 
     def subSequence(self, first: int, length: int):
         return PairSequences(
@@ -73,108 +103,6 @@ class Substitution:
         return ret
 
 
-class SuffixTree:
-    class StringPosition:
-        def __init__(self, string, position, prevelem):
-            self.string = string
-            self.position = position
-            self.prevelem = prevelem
-
-    class SuffixTreeNode:
-        def __init__(self):
-            self.childs = {}  #
-            self.string_positions = []
-            self.ending_strings = []
-
-    def __init__(self, f_code: Callable):
-        self._node = self.SuffixTreeNode()
-        self._f_code = f_code
-
-    def _add(self, string, prevelem):
-        pos = 0
-        node = self._node
-        for pos in range(len(string)):
-            e = string[pos]
-            code = self._f_code(e)
-            node.string_positions.append(self.StringPosition(string, pos, prevelem))
-            if code not in node.childs:
-                node.childs[code] = self.SuffixTreeNode()
-            node = node.childs[code]
-        node.ending_strings.append(self.StringPosition(string, pos + 1, prevelem))
-
-    def add(self, string: StatementSequence):
-        for i in range(len(string)):
-            if i == 0:
-                prevelem = None
-            else:
-                prevelem = self._f_code(string[i - 1])
-            self._add(string[i:], prevelem)
-
-    def getBestMaxSubstrings(
-        self,
-        threshold,
-        f,
-        f_elem,
-        node=None,
-        initial_threshold=None,
-    ):
-        initial_threshold = threshold or 0
-
-        def check_left_diverse_and_add(s1, s2, p):
-            if (
-                (not s1.prevelem) or (not s2.prevelem) or (s1.prevelem != s2.prevelem)
-            ) and s1.position > p:
-                candidate = (
-                    s1.string[: s1.position - p],
-                    s2.string[: s2.position - p],
-                )
-                if (
-                    f_elem(candidate[0]) >= initial_threshold
-                    or f_elem(candidate[1]) >= initial_threshold
-                ):
-                    r.append(candidate)
-                return True
-            else:
-                return False
-
-        if not node:
-            node = self._node
-        r = []
-        if threshold <= 0:
-            for s1 in node.ending_strings:
-                for s2 in node.string_positions:
-                    if s1.string == s2.string:
-                        continue
-                    check_left_diverse_and_add(s1, s2, 0)
-            for i in range(len(node.ending_strings)):
-                for j in range(i):
-                    s1 = node.ending_strings[i]
-                    s2 = node.ending_strings[j]
-                    check_left_diverse_and_add(s1, s2, 0)
-            for i in range(len(list(node.childs.keys()))):
-                for j in range(i):
-                    c1 = list(node.childs.keys())[i]
-                    c2 = list(node.childs.keys())[j]
-                    for s1 in (
-                        node.childs[c1].string_positions
-                        + node.childs[c1].ending_strings
-                    ):
-                        for s2 in (
-                            node.childs[c2].string_positions
-                            + node.childs[c2].ending_strings
-                        ):
-                            check_left_diverse_and_add(s1, s2, 1)
-        for code, child in list(node.childs.items()):
-            r += self.getBestMaxSubstrings(
-                threshold - f(code),
-                f,
-                f_elem,
-                child,
-                initial_threshold,
-            )
-        return r
-
-
 class Unifier:
     # Unifier is used instead of AntiUnifier
     def __init__(
@@ -248,6 +176,104 @@ class Unifier:
         return sum([s.getSize(free_variable_cost=self.cfg.free_variable_cost) for s in self.substitutions])
 
 
+def substitution_pairs(t1, t2, cfg, limit: float = math.inf, weights=(1, 1)):
+    """Distinct pairs of subtrees that Unifier(t1, t2) replaces with free variables.
+
+    The pairs are (id, id, size, size) tuples, found without building the
+    pattern or the substitutions. The cost of a pair is
+    w1 * (size1 - free_variable_cost) + w2 * (size2 - free_variable_cost);
+    None is returned as soon as the total is over limit. No cost is negative
+    while the free variable cost is at most 1, otherwise limit is ignored.
+    """
+    free_variable_cost = cfg.free_variable_cost
+    if free_variable_cost > 1:
+        limit = math.inf
+    w1, w2 = weights
+    pairs = {}
+    cost = 0
+    stack = [(t1, t2)]
+    while stack:
+        node1, node2 = stack.pop()
+        cid1, cid2 = node1.getCanonicalId(), node2.getCanonicalId()
+        if cid1 == cid2:
+            continue
+        if node1.name == node2.name and len(node1.childs) == len(node2.childs):
+            stack.extend(zip(reversed(node1.childs), reversed(node2.childs)))
+            continue
+        if (cid1, cid2) in pairs:
+            continue
+        for node in (node1, node2):
+            if node._size is None:
+                node.storeSize(free_variable_cost=free_variable_cost)
+        size1, size2 = node1.getSize(False), node2.getSize(False)
+        pairs[cid1, cid2] = (size1, size2)
+        cost += w1 * (size1 - free_variable_cost) + w2 * (size2 - free_variable_cost)
+        if cost > limit:
+            return None
+    return tuple((cid1, cid2, size1, size2) for (cid1, cid2), (size1, size2) in pairs.items())
+
+
+class UnificationCache:
+    """Bounded memo of unification results, keyed by canonical ids of the trees.
+
+    Only the substitution pairs are kept, which is enough for the costs of
+    clusters and the distances of sequences. The least recently used results
+    are dropped once there are more than size of them.
+    """
+
+    def __init__(self, size: int = 65536):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.aborted = 0
+        self._results = OrderedDict()
+
+    def clear(self, size: int = None):
+        if size is not None:
+            self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.aborted = 0
+        self._results.clear()
+
+    def get(
+        self, t1: AbstractSyntaxTree, t2: AbstractSyntaxTree, cfg, limit=math.inf, weights=(1, 1)
+    ):
+        """substitution_pairs of t1 and t2, None if their cost is over limit."""
+        key = (t1.getCanonicalId(), t2.getCanonicalId(), cfg.free_variable_cost)
+        r = self._results.get(key)
+        if r is not None:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return r
+        self.misses += 1
+        r = substitution_pairs(t1, t2, cfg, limit, weights)
+        if r is None:
+            self.aborted += 1
+            return None
+        if self.size > 0:
+            self._results[key] = r
+            if len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return r
+
+    def getCost(
+        self, t1: AbstractSyntaxTree, t2: AbstractSyntaxTree, cfg, limit=math.inf, weights=(1, 1)
+    ) -> float:
+        """Weighted unification cost of t1 and t2, inf if it is over limit."""
+        pairs = self.get(t1, t2, cfg, limit, weights)
+        if pairs is None:
+            return math.inf
+        w1, w2 = weights
+        free_variable_cost = cfg.free_variable_cost
+        return w1 * sum(e[2] - free_variable_cost for e in pairs) + w2 * sum(
+            e[3] - free_variable_cost for e in pairs
+        )
+
+
+unification_cache = UnificationCache()
+
+
 class Cluster:
     count = 0
 
@@ -267,11 +293,9 @@ class Cluster:
     def __len__(self):
         return len(self._trees)
 
-    def getAddCost(self, statement: AbstractSyntaxTree):
-        unifier = Unifier(self.pattern, statement, cfg=self.cfg)
-        return (
-            len(self) * unifier.substitutions[0].getSize(free_variable_cost=self.cfg.free_variable_cost)
-            + unifier.substitutions[1].getSize(free_variable_cost=self.cfg.free_variable_cost)
+    def getAddCost(self, statement: AbstractSyntaxTree, limit: float = math.inf):
+        return unification_cache.getCost(
+            self.pattern, statement, self.cfg, limit, weights=(len(self), 1)
         )
 
     def unify(self, statement: AbstractSyntaxTree):
@@ -290,7 +314,27 @@ class Cluster:
 def calc_statement_sizes(statement_sequences, cfg):
     for sequence in statement_sequences:
         for statement in sequence:
-            statement.storeSize(free_variable_cost=cfg.free_variable_cost)
+            if statement._size is None:
+                statement.storeSize(free_variable_cost=cfg.free_variable_cost)
+
+
+def assign_canonical_ids(statement_sequences):
+    # ids are per process, so they are assigned here rather than while parsing
+    for sequence in statement_sequences:
+        for statement in sequence:
+            statement.getCanonicalId()
+
+
+def reset_canonical_ids(source_files: list):
+    """Start a new table of canonical ids for the trees of source_files.
+
+    Ids the trees got in an earlier run are dropped, as they come from a
+    table that is gone. The unification cache is keyed by ids and has to
+    be cleared with it.
+    """
+    clear_canonical_ids()
+    for source_file in source_files:
+        source_file._tree.resetCanonicalIds()
 
 
 def build_hash_to_statement(statement_sequences, cfg, dcup_hash=True):
@@ -298,7 +342,6 @@ def build_hash_to_statement(statement_sequences, cfg, dcup_hash=True):
     for sequence in statement_sequences:
         for statement in sequence:
             if dcup_hash:
-                # 3 - CONSTANT HERE!
                 h = statement.getDCupHash(cfg.hashing_depth)
             else:
                 h = statement.getFullHash()
@@ -316,24 +359,34 @@ def build_unifiers(hash_to_statement, cfg):
     for h in list(hash_to_statement.keys()):
         local_clusters = []
         statements = hash_to_statement[h]
+        index = None
+        if 0 < cfg.cluster_index <= len(statements):
+            index = ClusterIndex()
         for statement in statements:
             processed_statements_count += 1
             if (processed_statements_count % 1000) == 0:
                 logger.debug(f"{processed_statements_count},")
             bestcluster = None
             mincost = sys.maxsize
-            for cluster in local_clusters:
-                cost = cluster.getAddCost(statement)
+            for cluster in index.candidates(statement) if index else local_clusters:
+                # costs over the threshold or the best one so far do not matter
+                cost = cluster.getAddCost(
+                    statement, limit=min(mincost, cfg.clustering_threshold)
+                )
                 if cost < mincost:
                     mincost = cost
                     bestcluster = cluster
-            assert local_clusters == [] or bestcluster
+            # bestcluster is None when every cost was over the threshold
             assert mincost >= 0
             if (not bestcluster) or mincost > cfg.clustering_threshold:
                 newcluster = Cluster(statement, cfg=cfg)
                 local_clusters.append(newcluster)
+                if index:
+                    index.add(newcluster, statement)
             else:
                 bestcluster.unify(statement)
+                if index:
+                    index.add(bestcluster, statement)
         ret[h] = local_clusters
         clusters.extend(local_clusters)
     return ret
@@ -344,41 +397,177 @@ def clusterize(hash_to_statement, clusters_map, cfg):
     # therefore it will work correct even if unifiers are smaller than hashing depth value
     for k, v in hash_to_statement.items():
         clusters = clusters_map[k]
+        index = None
+        if 0 < cfg.cluster_index <= len(v):
+            # candidates of a statement always include the cluster it was built into
+            index = ClusterIndex()
+            home = {}
+            for cluster in clusters:
+                for statement in cluster._trees:
+                    index.add(cluster, statement)
+                    home[id(statement)] = cluster
         for statement in v:
             mincost = sys.maxsize
-            for cluster in clusters:
-                unifier = Unifier(cluster.pattern, statement, cfg=cfg)
-                cost = unifier.getSize()
+            candidates = clusters
+            if index:
+                candidates = index.candidates(statement, extra=[home[id(statement)]])
+            for cluster in candidates:
+                cost = unification_cache.getCost(cluster.pattern, statement, cfg, limit=mincost)
                 if cost < mincost:
                     mincost = cost
                     statement.mark = cluster
                     cluster.addWithoutUnification(statement)
 
 
-def filter_long_sequences(statement_sequences):
-    sequences_without_restriction = statement_sequences
-    statement_sequences = []
-    for sequence in sequences_without_restriction:
-        new_sequence = copy.copy(sequence._sequence)
-        current_mark = None
-        length = 0
-        first_statement_index = None
-        flag = False
-        for i in range(len(sequence)):
-            statement = sequence[i]
-            if statement.mark != current_mark:
-                if flag:
-                    flag = False
-                current_mark = statement.mark
-                length = 0
-                first_statement_index = i
-            else:
-                length += 1
-                if length > 10:
-                    new_sequence[i] = None
-                    if not flag:
-                        for i in range(first_statement_index, i):
-                            new_sequence[i] = None
+def _detach(tree: AbstractSyntaxTree) -> AbstractSyntaxTree:
+    # a copy of the structure only, without lines, parents and the source file
+    r = AbstractSyntaxTree(tree.name)
+    for child in tree.childs:
+        r.addChild(_detach(child))
+    return r
+
+
+def _renumber(tree: AbstractSyntaxTree, offset: int, seen: set):
+    if id(tree) in seen:
+        return
+    seen.add(id(tree))
+    if isinstance(tree, FreeVariable):
+        tree.name = "VAR(%d)" % (int(tree.name[4:-1]) + offset)
+        tree._hash = None
+    for child in tree.childs:
+        _renumber(child, offset, seen)
+
+
+def _cluster_buckets(buckets: list, cfg) -> list:
+    """build_unifiers and clusterize for each bucket of detached statements.
+
+    For every bucket the result has, for each cluster, the indices of its
+    statements in the order they were added, how many of them were unified
+    and the pattern (None if it is the first statement); then the index of
+    the cluster that marks each statement, the number of the first free
+    variable made and the count of them.
+    """
+    results = []
+    for statements in buckets:
+        for statement in statements:
+            statement._covered_line_numbers = ()  # not needed to build patterns
+        first_variable = FreeVariable.count
+        clusters = build_unifiers({0: statements}, cfg)
+        unified = [len(cluster) for cluster in clusters[0]]
+        clusterize({0: statements}, clusters, cfg)
+        position = {id(statement): i for i, statement in enumerate(statements)}
+        cluster_index = {id(cluster): i for i, cluster in enumerate(clusters[0])}
+        results.append(
+            (
+                [
+                    (
+                        [position[id(statement)] for statement in cluster._trees],
+                        n,
+                        None if cluster.pattern is cluster._trees[0] else cluster.pattern,
+                    )
+                    for cluster, n in zip(clusters[0], unified)
+                ],
+                [cluster_index[id(statement.mark)] for statement in statements],
+                first_variable,
+                FreeVariable.count - first_variable,
+            )
+        )
+    return results
+
+
+def _replay_bucket(statements: list, result, cfg):
+    # the same Cluster objects, marks and free variable numbers as a serial run
+    clusters_info, marks, first_variable, variable_count = result
+    offset = FreeVariable.count - first_variable
+    clusters = []
+    for members, unified, pattern in clusters_info:
+        cluster = Cluster(statements[members[0]], cfg=cfg)
+        cluster._trees.extend(statements[i] for i in members[1:unified])
+        if pattern is not None:
+            _renumber(pattern, offset, set())
+            cluster.pattern = pattern
+        for i in members[unified:]:
+            cluster.addWithoutUnification(statements[i])
+        clusters.append(cluster)
+    FreeVariable.count += variable_count
+    for statement, i in zip(statements, marks):
+        statement.mark = clusters[i]
+
+
+def build_patterns_parallel(hash_to_statement, cfg, jobs: int):
+    """build_unifiers and clusterize on `jobs` processes, with the marks of a serial run.
+
+    The clusters of a bucket do not depend on other buckets. Buckets with
+    more than one statement are detached and sharded by their estimated cost,
+    the squared size, largest first onto the least loaded worker. Results are
+    replayed in bucket order, so clusters and free variables get the same
+    numbers as in a serial run.
+    """
+    buckets = list(hash_to_statement.values())
+    shards = [[] for _ in range(jobs)]
+    loads = [0] * jobs
+    for k in sorted(
+        (k for k in range(len(buckets)) if len(buckets[k]) > 1),
+        key=lambda k: -len(buckets[k]),
+    ):
+        i = loads.index(min(loads))
+        shards[i].append(k)
+        loads[i] += len(buckets[k]) ** 2
+    shards = [e for e in shards if e]
+    results = {}
+    if len(shards) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+            futures = [
+                (
+                    shard,
+                    pool.submit(
+                        _cluster_buckets,
+                        [[_detach(e) for e in buckets[k]] for k in shard],
+                        cfg,
+                    ),
+                )
+                for shard in shards
+            ]
+            for shard, future in futures:
+                try:
+                    results.update(zip(shard, future.result()))
+                except RecursionError:
+                    pass  # too deep to be sent to a worker, clustered below
+    for k, statements in enumerate(buckets):
+        if k in results:
+            _replay_bucket(statements, results[k], cfg)
+        else:
+            clusters_map = build_unifiers({k: statements}, cfg)
+            clusterize({k: statements}, clusters_map, cfg)
+
+
+def kept_statement_ranges(marks, sequence=None) -> list[tuple[int, int]]:
+    """Ranges of a sequence left once runs of many statements with equal marks are dropped.
+
+    The dropped runs are logged when the statements of the sequence are given.
+    """
+    keep = [True] * len(marks)
+    current_mark = None
+    length = 0
+    first_statement_index = None
+    flag = False
+    for i, mark in enumerate(marks):
+        if mark != current_mark:
+            flag = False
+            current_mark = mark
+            length = 0
+            first_statement_index = i
+        else:
+            length += 1
+            if length > 10:
+                keep[i] = False
+                if not flag:
+                    for j in range(first_statement_index, i):
+                        keep[j] = False
+                    flag = True
+                    if sequence is not None:
                         first_statement = sequence[first_statement_index]
                         logger.warning(
                             f"Warning: sequence of statements starting at "
@@ -389,17 +578,23 @@ def filter_long_sequences(statement_sequences):
                             "consists of many similar statements; "
                             "It will be ignored. Use --force to override this restriction."
                         )
-                        flag = True
-        new_sequence = new_sequence + [None]
-        cur_sequence = StatementSequence()
-        for statement in new_sequence:
-            if not statement:
-                if cur_sequence:
-                    statement_sequences.append(cur_sequence)
-                    cur_sequence = StatementSequence()
-            else:
-                cur_sequence.addStatement(statement)
-    return statement_sequences
+    ranges = []
+    start = None
+    for i, kept in enumerate(keep + [False]):
+        if kept and start is None:
+            start = i
+        elif not kept and start is not None:
+            ranges.append((start, i))
+            start = None
+    return ranges
+
+
+def filter_long_sequences(statement_sequences):
+    r = []
+    for sequence in statement_sequences:
+        for start, end in kept_statement_ranges([s.mark for s in sequence], sequence):
+            r.append(StatementSequence(sequence[start:end]))
+    return r
 
 
 def mark_using_hash(hash_to_statement, cfg):
@@ -410,67 +605,132 @@ def mark_using_hash(hash_to_statement, cfg):
             statement.mark = cluster
 
 
-def find_sequences(statement_sequences, cfg):
+def find_sequences(statement_sequences, cfg, instrumentation: Instrumentation = None):
     def f_size(x):
         return x.max_covered_lines
 
-    def f_elem(x):
-        return StatementSequence(x).getCoveredLineNumbersCount()
-
     def f_code(x):
         return x.mark
 
-    suffix_tree_instance = SuffixTree(f_code)
+    suffix_array_instance = SuffixArray(f_code)
     for sequence in statement_sequences:
-        suffix_tree_instance.add(sequence)
-    return [
-        PairSequences([StatementSequence(s1), StatementSequence(s2)], cfg=cfg)
-        for (s1, s2) in suffix_tree_instance.getBestMaxSubstrings(
-            cfg.size_threshold, f_size, f_elem
+        suffix_array_instance.add(sequence)
+    for (s1, s2) in suffix_array_instance.getBestMaxSubstrings(cfg.size_threshold, f_size):
+        candidate = PairSequences([StatementSequence(s1), StatementSequence(s2)], cfg=cfg)
+        # marks only bound the lines of their statements, one side has to cover enough
+        if any(e.getCoveredLineNumbersCount() >= cfg.size_threshold for e in candidate):
+            yield candidate
+    if instrumentation is not None:
+        instrumentation.count("lcp_intervals", suffix_array_instance.intervals)
+
+
+class RefineTable:
+    """Costs and covered lines of the statement pairs of a duplicate candidate.
+
+    They are computed once per candidate, windows are then checked from
+    prefix sums. The cost of a window is at most the sum of the costs of its
+    statement pairs, as substitutions shared between statements are paid
+    once, and at least the largest of them, so windows are only unified
+    exactly when the threshold lies between the two.
+    """
+
+    def __init__(self, pair_sequences: PairSequences, cfg):
+        self.cfg = cfg
+        free_variable_cost = cfg.free_variable_cost
+        self.pairs = [unification_cache.get(t1, t2, cfg) for t1, t2 in zip(*pair_sequences)]
+        self.costs = array(
+            "d", (sum(e[2] + e[3] - 2 * free_variable_cost for e in p) for p in self.pairs)
         )
-    ]
+        self.cost_sums = array("d", accumulate(self.costs, initial=0))
+        self.sequences = list(pair_sequences)
+        self.line_sums = []  # per sequence, None if its statements share lines
+        for sequence in pair_sequences:
+            counts = [len(s.getCoveredLineNumbers()) for s in sequence]
+            if sum(counts) == sequence.getCoveredLineNumbersCount():
+                self.line_sums.append(array("q", accumulate(counts, initial=0)))
+            else:
+                self.line_sums.append(None)
+
+    def getMaxCoveredLineNumbersCount(self, first: int, length: int) -> int:
+        counts = []
+        for sequence, line_sums in zip(self.sequences, self.line_sums):
+            if line_sums is None:
+                covered = set()
+                for statement in sequence[first : first + length]:
+                    covered.update(statement.getCoveredLineNumbers())
+                counts.append(len(covered))
+            else:
+                counts.append(line_sums[first + length] - line_sums[first])
+        return min(counts)
+
+    def isDistanceBelow(self, first: int, length: int, limit: float) -> bool:
+        free_variable_cost = self.cfg.free_variable_cost
+        bounded = free_variable_cost <= 1  # otherwise costs may be negative
+        if bounded:
+            if self.cost_sums[first + length] - self.cost_sums[first] < limit:
+                return True
+            if max(self.costs[first : first + length]) >= limit:
+                return False
+        return self.calcDistance(first, length, limit) < limit
+
+    def calcDistance(self, first: int, length: int, limit: float = math.inf):
+        """Same as PairSequences.calcDistance for a window."""
+        free_variable_cost = self.cfg.free_variable_cost
+        if free_variable_cost > 1:
+            limit = math.inf
+        seen = set()
+        cost = 0
+        for pairs in self.pairs[first : first + length]:
+            for cid1, cid2, size1, size2 in pairs:
+                if (cid1, cid2) not in seen:
+                    seen.add((cid1, cid2))
+                    cost += size1 + size2 - 2 * free_variable_cost
+                    if cost > limit:
+                        return math.inf
+        return cost
 
 
 def refine_duplicate_candidates(pairs_sequences, cfg):
+    """Clones in the candidates, which may be any iterable, even a generator.
+
+    Each candidate is split into ranges: the longest and then leftmost window
+    of a range that is large enough and close enough is a clone, the rest of
+    the range on both sides is refined again.
+    """
     r = []
-    flag = False
-    while pairs_sequences:
-        pair_sequences = pairs_sequences.pop()
-
-        def all_pairsubsequences_size_n_threshold(n):
-            lr = []
-            for first in range(0, len(pair_sequences) - n + 1):
-                new_pair_sequences = pair_sequences.subSequence(first, n)
-                size = new_pair_sequences.getMaxCoveredLineNumbersCount()
-                if size >= cfg.size_threshold:
-                    lr.append((new_pair_sequences, first))
-            return lr
-
-        n = len(pair_sequences) + 1
-        while n > 0:
-            n -= 1
-            new_pairs_sequences = all_pairsubsequences_size_n_threshold(n)
-            for (candidate_sequence, first) in new_pairs_sequences:
-                distance = candidate_sequence.calcDistance()
-                if distance < cfg.distance_threshold:
-                    r.append(candidate_sequence)
-                    if first > 0:
-                        pairs_sequences.append(
-                            pair_sequences.subSequence(0, first - 1)
-                        )
-                    if first + n < len(pair_sequences):
-                        pairs_sequences.append(
-                            pair_sequences.subSequence(
-                                first + n,
-                                len(pair_sequences) - first - n,
-                            )
-                        )
-                    n += 1
-                    flag = True
+    for candidate in pairs_sequences:
+        if candidate.getMaxCoveredLineNumbersCount() >= cfg.size_threshold:
+            candidate.distance = candidate.calcDistance(limit=cfg.distance_threshold)
+            if candidate.distance < cfg.distance_threshold:
+                r.append(candidate)  # most candidates are clones as a whole
+                continue
+            candidate.distance = None
+        table = RefineTable(candidate, cfg)
+        pending = [(0, len(candidate))]
+        while pending:
+            base, length = pending.pop()
+            accepted = None
+            for n in range(length, 0, -1):
+                for first in range(base, base + length - n + 1):
+                    if table.getMaxCoveredLineNumbersCount(
+                        first, n
+                    ) >= cfg.size_threshold and table.isDistanceBelow(
+                        first, n, cfg.distance_threshold
+                    ):
+                        accepted = first
+                        break
+                if accepted is not None:
                     break
-            if flag:
-                flag = False
-                break
+            if accepted is None:
+                continue
+            clone = candidate.subSequence(accepted, n)
+            clone.distance = table.calcDistance(accepted, n)
+            r.append(clone)
+            if accepted > base:
+                # one statement before the clone is left out, as it always was
+                pending.append((base, accepted - base - 1))
+            if accepted + n < base + length:
+                pending.append((accepted + n, base + length - accepted - n))
     return r
 
 
@@ -507,12 +767,35 @@ def remove_dominated_clones(clones):
     return ret_clones
 
 
-def main(source_files: list, cfg):
+def select_changed(statement_sequences, changed: set[str]):
+    """Sequences that can share a clone with a sequence from a changed file."""
+
+    def is_changed(sequence):
+        return str(sequence.source_file.file_name) in changed
+
+    changed_marks = set()
+    for sequence in statement_sequences:
+        if is_changed(sequence):
+            changed_marks.update(statement.mark for statement in sequence)
+    return [
+        sequence
+        for sequence in statement_sequences
+        if is_changed(sequence) or any(s.mark in changed_marks for s in sequence)
+    ]
+
+
+def main(source_files: list, cfg, index=None, instrumentation: Instrumentation = None):
+    instrumentation = instrumentation or Instrumentation()
+    unification_cache.clear(cfg.unification_cache_size)
+    reset_canonical_ids(source_files)
     statement_sequences = []
     statement_count = 0
     sequences_lengths = []
     for source_file in source_files:
-        sequences = get_statement_sequences(source_file._tree, size_threshold=cfg.size_threshold)
+        sequences = source_file.statement_sequences
+        if sequences is None:
+            sequences = get_statement_sequences(source_file._tree, size_threshold=cfg.size_threshold)
+            source_file.statement_sequences = sequences
         statement_sequences += sequences
         sequences_lengths += [len(s) for s in sequences]
         statement_count += sum([len(s) for s in sequences])
@@ -547,31 +830,42 @@ def main(source_files: list, cfg):
                     sequences.append(sequence)
 
     logger.debug(f"Number of statements: {statement_count}. Calculating size for each statement...")
-    calc_statement_sizes(statement_sequences, cfg)
+    instrumentation.count("sequences", len(sequences_lengths))
+    instrumentation.count("statements", statement_count)
+    instrumentation.histogram("sequence_lengths", sequences_lengths)
+    with instrumentation.phase("sizes"):
+        calc_statement_sizes(statement_sequences, cfg)
+        assign_canonical_ids(statement_sequences)
 
     logger.debug("Building statement hash...")
-    t0 = time.time()
-    hash_to_statement = build_hash_to_statement(
-        statement_sequences, cfg, dcup_hash=(not cfg.clusterize_using_hash)
-    )
-    logger.debug(f"Building statement hash: {time.time() - t0:.2f}s")
+    with instrumentation.phase("hashes"):
+        hash_to_statement = build_hash_to_statement(
+            statement_sequences, cfg, dcup_hash=(not cfg.clusterize_using_hash)
+        )
     logger.debug(f"Number of different hash values: {len(hash_to_statement)}")
+    instrumentation.count("hash_buckets", len(hash_to_statement))
+    instrumentation.histogram("hash_bucket_sizes", map(len, hash_to_statement.values()))
 
     if cfg.clusterize_using_dcup or cfg.clusterize_using_hash:
         logger.debug("Marking each statement with its hash value")
-        mark_using_hash(hash_to_statement, cfg)
+        with instrumentation.phase("mark_using_hash"):
+            mark_using_hash(hash_to_statement, cfg)
     else:
         logger.debug("Building patterns...")
-        t0 = time.time()
-        clusters_map = build_unifiers(hash_to_statement, cfg)
-        logger.debug(f"Building patterns: {time.time() - t0:.2f}s")
-        logger.debug(
-            f"{Cluster.count} patterns were discovered. Choosing pattern for each statement..."
-        )
-
-        t0 = time.time()
-        clusterize(hash_to_statement, clusters_map, cfg)
-        logger.debug(f"Marking similar statements: {time.time() - t0:.2f}s")
+        first_cluster = Cluster.count
+        jobs = cfg.jobs or os.cpu_count() or 1
+        if jobs > 1:
+            with instrumentation.phase("build_patterns_parallel"):
+                build_patterns_parallel(hash_to_statement, cfg, jobs)
+        else:
+            with instrumentation.phase("build_unifiers"):
+                clusters_map = build_unifiers(hash_to_statement, cfg)
+            logger.debug(
+                f"{Cluster.count} patterns were discovered. Choosing pattern for each statement..."
+            )
+            with instrumentation.phase("clusterize"):
+                clusterize(hash_to_statement, clusters_map, cfg)
+        instrumentation.count("patterns", Cluster.count - first_cluster)
 
     mark_to_statement_hash = None
     if cfg.report_unifiers:
@@ -589,36 +883,90 @@ def main(source_files: list, cfg):
     if not cfg.force:
         statement_sequences = filter_long_sequences(statement_sequences)
 
-    t0 = time.time()
-    duplicate_candidates = find_sequences(statement_sequences, cfg)
-    logger.debug(f"Finding similar sequences: {time.time() - t0:.2f}s")
-    logger.debug(f"{len(duplicate_candidates)} sequences were found. Refining candidates...")
+    file_names = {str(e._source_file.file_name) for e in source_files}
+    changed = file_names
+    if index is not None and cfg.incremental:
+        if cfg.clusterize_using_dcup or cfg.clusterize_using_hash:
+            changed = index.changed_files(source_files, cfg)
+            logger.debug(f"Incremental update: {len(changed)} of {len(file_names)} files changed")
+        else:
+            logger.warning("Incremental update needs hash based marks, analysing all files")
+    search_sequences = statement_sequences
+    if changed != file_names:
+        search_sequences = select_changed(statement_sequences, changed)
+
+    candidate_count = 0
+
+    def candidates():
+        # generated lazily, refinement starts with the first candidate found
+        nonlocal candidate_count
+        for e in find_sequences(search_sequences, cfg, instrumentation):
+            if changed != file_names and not (
+                str(e[0].source_file.file_name) in changed
+                or str(e[1].source_file.file_name) in changed
+            ):
+                continue
+            candidate_count += 1
+            yield e
 
     if cfg.distance_threshold != -1:
-        t0 = time.time()
-        duplicate_candidates = refine_duplicate_candidates(duplicate_candidates, cfg)
-        logger.debug(f"Refining candidates: {time.time() - t0:.2f}s")
+        # candidates are found while they are refined, it is one phase
+        with instrumentation.phase("find_and_refine_sequences"):
+            duplicate_candidates = refine_duplicate_candidates(candidates(), cfg)
+    else:
+        with instrumentation.phase("find_sequences"):
+            duplicate_candidates = list(candidates())
+    logger.debug(f"{candidate_count} sequences were found")
+    instrumentation.count("candidates", candidate_count)
 
     logger.debug(f"{len(duplicate_candidates)} clones were found")
+    instrumentation.count("refined_clones", len(duplicate_candidates))
+    logger.debug(
+        f"Unification cache: {unification_cache.hits} hits, {unification_cache.misses} misses, "
+        f"{unification_cache.aborted} over the limit"
+    )
+    instrumentation.count("unification_cache_hits", unification_cache.hits)
+    instrumentation.count("unifications", unification_cache.misses)
+    instrumentation.count("unifications_over_limit", unification_cache.aborted)
     if cfg.distance_threshold != -1:
         logger.debug("Removing dominated clones...")
         old_clone_count = len(duplicate_candidates)
-        duplicate_candidates = remove_dominated_clones(duplicate_candidates)
+        with instrumentation.phase("remove_dominated_clones"):
+            duplicate_candidates = remove_dominated_clones(duplicate_candidates)
         logger.debug(f"{len(duplicate_candidates) - old_clone_count} clones were removed")
 
-    covered_source_lines = set()
-    for clone in duplicate_candidates:
-        for sequence in clone:
-            covered_source_lines = covered_source_lines.union(
-                sequence.getLineNumberHashables()
+    with instrumentation.phase("source_lines"):
+        source_lines = LineCoverage()
+        for sequence in statement_sequences:
+            source_lines.add(sequence)
+
+    if index is not None:
+        with instrumentation.phase("index"):
+            known_clones = []
+            if changed != file_names:
+                known_clones = index.load_clones(source_files, changed, cfg)
+            index.update(
+                source_files, changed, duplicate_candidates, cfg, source_lines=source_lines.counts()
             )
-    source_lines = set()
-    for sequence in statement_sequences:
-        source_lines = source_lines.union(sequence.getLineNumberHashables())
+            duplicate_candidates = known_clones + duplicate_candidates
+            instrumentation.count("known_clones", len(known_clones))
+    instrumentation.count("clones", len(duplicate_candidates))
+
+    with instrumentation.phase("distances_and_coverage"):
+        for clone in duplicate_candidates:
+            clone.storeDistances()
+
+        covered_source_lines = LineCoverage()
+        for clone in duplicate_candidates:
+            for sequence in clone:
+                covered_source_lines.add(sequence)
+        file_coverage, directory_coverage = covered_source_lines.percentages(source_lines)
 
     return dict(
         clones=duplicate_candidates,
         mark_to_statement_hash=mark_to_statement_hash,
         all_source_lines_count=len(source_lines),
         covered_source_lines_count=len(covered_source_lines),
+        file_coverage=file_coverage,
+        directory_coverage=directory_coverage,
     )
@@ -0,0 +1,230 @@
+from __future__ import annotations
+import json
+import sqlite3
+from pathlib import Path
+from clonedigger.backend.ast_wrapper import StatementSequence
+from clonedigger.backend.clone_detection_algorithm import PairSequences
+
+
+class CloneIndex:
+    """SQLite file with the results of the previous scan.
+
+    It records every file with its content digest and count of covered
+    lines, the mark, line range and covered line count of every statement
+    and the confirmed clone pairs. Statements and clones are addressed by
+    (path, sequence, position) in `ASTWrapper.statement_sequences`, which are
+    stable for a file as long as its digest, the settings and the skipped
+    function prefixes do not change. Indexes of separate scans are the
+    shards combined by `shards.merge`.
+    """
+
+    version = 2
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            source_lines INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS statements (
+            path TEXT NOT NULL,
+            sequence INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            mark INTEGER NOT NULL,
+            first_line INTEGER NOT NULL,
+            last_line INTEGER NOT NULL,
+            line_count INTEGER NOT NULL,
+            PRIMARY KEY (path, sequence, position)
+        );
+        CREATE INDEX IF NOT EXISTS statements_mark ON statements (mark);
+        CREATE TABLE IF NOT EXISTS clones (
+            path_a TEXT NOT NULL,
+            sequence_a INTEGER NOT NULL,
+            first_a INTEGER NOT NULL,
+            path_b TEXT NOT NULL,
+            sequence_b INTEGER NOT NULL,
+            first_b INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS clones_a ON clones (path_a);
+        CREATE INDEX IF NOT EXISTS clones_b ON clones (path_b);
+    """
+
+    def __init__(self, path: Path, readonly: bool = False, func_prefixes=()):
+        self.path = Path(path)
+        self.func_prefixes = list(func_prefixes)  # they decide which sequences exist
+        if readonly:
+            self._db = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True)
+            if self._user_version() != self.version:
+                self._db.close()
+                raise ValueError(f"{self.path} is not a clone index of version {self.version}")
+            return
+        self._db = sqlite3.connect(self.path)
+        if self._user_version() != self.version:
+            # tables of other versions are dropped, the next update fills them again
+            with self._db:
+                tables = self._db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+                for (table,) in tables.fetchall():
+                    self._db.execute(f"DROP TABLE {table}")
+            self._db.execute(f"PRAGMA user_version = {self.version}")
+        self._db.executescript(self.schema)
+
+    def _user_version(self) -> int:
+        return self._db.execute("PRAGMA user_version").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    @classmethod
+    def settings_key(cls, cfg, func_prefixes=()) -> str:
+        # settings that change marks, sequences or the accepted clones
+        fields = [
+            "hashing_depth",
+            "size_threshold",
+            "distance_threshold",
+            "clustering_threshold",
+            "clusterize_using_dcup",
+            "clusterize_using_hash",
+            "free_variable_cost",
+            "force",
+        ]
+        return json.dumps(
+            [cls.version] + [getattr(cfg, k) for k in fields] + [sorted(func_prefixes)]
+        )
+
+    def _meta(self, key: str):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def matches(self, cfg) -> bool:
+        """Whether the index was written with settings giving the same marks and clones."""
+        return self._meta("settings") == self.settings_key(cfg, self.func_prefixes)
+
+    def files(self) -> list[tuple[str, str, int]]:
+        """(path, digest, covered line count) of every recorded file."""
+        rows = self._db.execute("SELECT path, digest, source_lines FROM files ORDER BY path")
+        return rows.fetchall()
+
+    def statement_marks(self):
+        """(path, sequence, position, mark, covered line count) of every statement, in order."""
+        return self._db.execute(
+            "SELECT path, sequence, position, mark, line_count FROM statements "
+            "ORDER BY path, sequence, position"
+        )
+
+    def clone_files(self) -> set[str]:
+        """Names of the files with recorded clones."""
+        rows = self._db.execute("SELECT path_a FROM clones UNION SELECT path_b FROM clones")
+        return {path for (path,) in rows}
+
+    def changed_files(self, source_files: list, cfg) -> set[str]:
+        """Names of files that were added or modified since the last update."""
+        names = {_name(e): e.digest for e in source_files}
+        if not self.matches(cfg):
+            return set(names)
+        known = dict(self._db.execute("SELECT path, digest FROM files"))
+        return {k for k, v in names.items() if known.get(k) != v}
+
+    def load_clones(self, source_files: list, skip: set[str], cfg) -> list[PairSequences]:
+        """Stored clone pairs between current files, except those touching skip."""
+        files = {_name(e): e for e in source_files}
+        clones = []
+        for path_a, seq_a, first_a, path_b, seq_b, first_b, length in self._db.execute(
+            "SELECT path_a, sequence_a, first_a, path_b, sequence_b, first_b, length FROM clones"
+        ):
+            if {path_a, path_b} & skip or not {path_a, path_b} <= files.keys():
+                continue
+            clones.append(
+                PairSequences(
+                    [
+                        StatementSequence(
+                            files[path].statement_sequences[seq][first : first + length]
+                        )
+                        for path, seq, first in ((path_a, seq_a, first_a), (path_b, seq_b, first_b))
+                    ],
+                    cfg=cfg,
+                )
+            )
+        return clones
+
+    def update(
+        self, source_files: list, changed: set[str], clones: list, cfg, source_lines: dict = None
+    ):
+        """Replace everything recorded for changed and removed files.
+
+        clones are the new clone pairs, each of them touches a changed file.
+        source_lines are the counts of lines covered by statements per file name.
+        """
+        source_lines = source_lines or {}
+        names = {_name(e) for e in source_files}
+        stale = changed | {
+            path for (path,) in self._db.execute("SELECT path FROM files") if path not in names
+        }
+        positions = {}
+        for source_file in source_files:
+            for i, sequence in enumerate(source_file.statement_sequences):
+                for j, statement in enumerate(sequence):
+                    positions[id(statement)] = (i, j)
+
+        with self._db:
+            for path in stale:
+                for table in ("files", "statements"):
+                    self._db.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+                self._db.execute(
+                    "DELETE FROM clones WHERE path_a = ? OR path_b = ?", (path, path)
+                )
+            for source_file in source_files:
+                path = _name(source_file)
+                if path not in changed:
+                    continue
+                self._db.execute(
+                    "INSERT INTO files VALUES (?, ?, ?)",
+                    (path, source_file.digest, source_lines.get(path, 0)),
+                )
+                self._db.executemany(
+                    "INSERT INTO statements VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            path,
+                            i,
+                            j,
+                            _mark(statement, cfg),
+                            min(statement.getCoveredLineNumbers()),
+                            max(statement.getCoveredLineNumbers()),
+                            len(statement.getCoveredLineNumbers()),
+                        )
+                        for i, sequence in enumerate(source_file.statement_sequences)
+                        for j, statement in enumerate(sequence)
+                    ],
+                )
+            self._db.executemany(
+                "INSERT INTO clones VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        str(clone[0].source_file.file_name),
+                        *positions[id(clone[0][0])],
+                        str(clone[1].source_file.file_name),
+                        *positions[id(clone[1][0])],
+                        len(clone),
+                    )
+                    for clone in clones
+                ],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('settings', ?)",
+                (self.settings_key(cfg, self.func_prefixes),),
+            )
+
+
+def _name(source_file) -> str:
+    return str(source_file._source_file.file_name)
+
+
+def _mark(statement, cfg) -> int:
+    # marks are recorded as the statement hash the clusters were built from
+    if cfg.clusterize_using_hash:
+        return statement.getFullHash()
+    return statement.getDCupHash(cfg.hashing_depth)
@@ -0,0 +1,66 @@
+from __future__ import annotations
+import random
+from clonedigger.backend.ast_wrapper import AbstractSyntaxTree, name_hash
+
+
+class ClusterIndex:
+    """MinHash/LSH index of clusters over node-kind shingles of their statements.
+
+    The shingles of a tree are its (parent kind, child kind) edges. A cluster
+    is stored under the signature bands of each of its statements, rather
+    than of its pattern: free variables make a pattern match more statements
+    than its own shingles suggest. Clusters sharing a band with a statement
+    are its candidates. Two statements with a Jaccard similarity of 0.5 share
+    a band with probability about 0.9.
+    """
+
+    prime = (1 << 61) - 1
+
+    def __init__(self, bands: int = 8, rows: int = 2):
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(0)
+        self._params = [
+            (rng.randrange(1, self.prime), rng.randrange(self.prime)) for _ in range(bands * rows)
+        ]
+        self._buckets = {}
+        self._order = {}  # cluster -> insertion number, candidates keep this order
+        self._keys = {}  # id of a statement -> its band keys
+
+    def signature(self, tree: AbstractSyntaxTree) -> tuple:
+        shingles = set()
+        stack = [tree]
+        while stack:
+            t = stack.pop()
+            for child in t.childs:
+                shingles.add(name_hash(f"{t.name}>{child.name}"))
+                stack.append(child)
+        if not shingles:
+            shingles.add(name_hash(tree.name))
+        return tuple(min((a * x + b) % self.prime for x in shingles) for a, b in self._params)
+
+    def _band_keys(self, statement: AbstractSyntaxTree) -> list:
+        # statements are kept alive by the caller while the index is used
+        keys = self._keys.get(id(statement))
+        if keys is None:
+            signature = self.signature(statement)
+            keys = [
+                (i, signature[i * self.rows : (i + 1) * self.rows]) for i in range(self.bands)
+            ]
+            self._keys[id(statement)] = keys
+        return keys
+
+    def add(self, cluster, statement: AbstractSyntaxTree):
+        """Make cluster a candidate for statements similar to statement."""
+        self._order.setdefault(cluster, len(self._order))
+        for key in self._band_keys(statement):
+            bucket = self._buckets.setdefault(key, [])
+            if not bucket or bucket[-1] is not cluster:
+                bucket.append(cluster)
+
+    def candidates(self, statement: AbstractSyntaxTree, extra=()) -> list:
+        """Indexed clusters similar to statement and extra ones, in insertion order."""
+        r = set(extra)
+        for key in self._band_keys(statement):
+            r.update(self._buckets.get(key, ()))
+        return sorted(r, key=self._order.__getitem__)
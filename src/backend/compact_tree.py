@@ -0,0 +1,301 @@
+from __future__ import annotations
+import ast
+import sys
+from array import array
+from clonedigger.backend.ast_wrapper import (
+    HashMixin,
+    LineMixin,
+    SizeMixin,
+    SourceFile,
+    canonical_id,
+    name_hash,
+)
+
+
+class CompactTree:
+    """Flat, array based storage of a parsed file.
+
+    Builds the same tree as `NT` does, straight from the `ast` module nodes,
+    without keeping them. Nodes are numbered breadth first, so the children of
+    a node are `first_child[i] .. first_child[i] + child_count[i] - 1` and the
+    next sibling of a node is the following index. Kind names are interned in
+    `kinds`. Line ranges, heights and sizes are computed once while building.
+    """
+
+    def __init__(self, source_file: SourceFile = None):
+        self.source_file = source_file
+        self.kinds = []
+        self._kind_ids = {}
+        self.kind = array("I")
+        self.parent = array("i")
+        self.first_child = array("i")
+        self.child_count = array("I")
+        self.first_line = array("i")  # lines of the node itself, -1 if it has none
+        self.last_line = array("i")
+        self.height = array("I")
+        self.size = array("I")  # count of distinct leaf kinds, see SizeMixin.storeSize
+        self.has_none = array("B")
+        self.is_statement = array("B")
+        self.hash_depth = -1  # DCup hashes of levels 0..hash_depth are in dcup
+        self.dcup = array("q")  # hash_depth + 1 values per node
+        self.full_hash = array("q")
+        self.cid = array("q")  # canonical ids, empty until assigned
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_kind_ids"]
+        state["cid"] = array("q")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._kind_ids = {e: i for i, e in enumerate(self.kinds)}
+
+    def _kind_id(self, name: str) -> int:
+        if name not in self._kind_ids:
+            self._kind_ids[name] = len(self.kinds)
+            self.kinds.append(sys.intern(name))
+        return self._kind_ids[name]
+
+    @classmethod
+    def from_ast(cls, node: ast.AST, ignored_statements=(), source_file: SourceFile = None):
+        tree = cls(source_file)
+        pending = [node]
+        pending_parent = [-1]
+        i = 0
+        while i < len(pending):
+            value = pending[i]
+            pending[i] = None
+            name = value.__class__.__name__
+            first = last = -1
+            is_statement = False
+            children = []
+            if isinstance(value, ast.AST):
+                if name in ignored_statements:
+                    name = "None"
+                else:
+                    is_statement = isinstance(value, ast.stmt)
+                    if "lineno" in value._attributes:
+                        first = value.lineno - 1
+                        last = getattr(value, "end_lineno", value.lineno) - 1
+                    for _, child in ast.iter_fields(value):
+                        if isinstance(child, list):
+                            children.extend(e for e in child if e is not None)
+                        else:
+                            children.append(child)
+            elif not value:
+                # as in NT.prepare_node, empty constants become None as well
+                name = "None"
+            tree.kind.append(tree._kind_id(name))
+            tree.parent.append(pending_parent[i])
+            tree.first_child.append(len(pending) if children else -1)
+            tree.child_count.append(len(children))
+            tree.first_line.append(first)
+            tree.last_line.append(last)
+            tree.is_statement.append(is_statement)
+            pending.extend(children)
+            pending_parent.extend([i] * len(children))
+            i += 1
+        tree._propagate()
+        return tree
+
+    def _propagate(self):
+        # children always follow their parent, so a reversed pass is bottom up
+        n = len(self)
+        height = [0] * n
+        leaf_kinds = [0] * n  # bit masks of kind ids
+        for i in range(n - 1, -1, -1):
+            if not self.child_count[i]:
+                leaf_kinds[i] |= 1 << self.kind[i]
+            p = self.parent[i]
+            if p >= 0:
+                leaf_kinds[p] |= leaf_kinds[i]
+                height[p] = max(height[p], height[i] + 1)
+        none_bit = 1 << self._kind_id("None")
+        self.height = array("I", height)
+        self.size = array("I", (bin(e).count("1") for e in leaf_kinds))
+        self.has_none = array("B", (bool(e & none_bit) for e in leaf_kinds))
+
+    def propagateHashes(self, depth: int):
+        """Same values as HashMixin.propagateHashes, for all nodes at once."""
+        if self.hash_depth >= depth:
+            return
+        n = len(self)
+        width = depth + 1
+        dcup = array("q", bytes(8 * n * width))
+        full_hash = array("q", bytes(8 * n))
+        for i in range(n - 1, -1, -1):
+            count = self.child_count[i]
+            if not count:
+                continue
+            first = self.first_child[i]
+            base = name_hash(self.kinds[self.kind[i]]) * count
+            dcup[i * width] = hash(base)
+            for level in range(1, width):
+                ret = (level + 1) * base
+                for j in range(count):
+                    ret += (j + 1) * dcup[(first + j) * width + level - 1]
+                dcup[i * width + level] = hash(ret)
+            ret = base
+            for j in range(count):
+                ret += (j + 1) * full_hash[first + j]
+            full_hash[i] = hash(ret)
+        self.hash_depth = depth
+        self.dcup = dcup
+        self.full_hash = full_hash
+
+    def assignCanonicalIds(self):
+        if self.cid:
+            return
+        n = len(self)
+        cid = [0] * n
+        for i in range(n - 1, -1, -1):
+            first = self.first_child[i]
+            cid[i] = canonical_id(
+                self.kinds[self.kind[i]],
+                tuple(cid[first : first + self.child_count[i]]) if first >= 0 else (),
+            )
+        self.cid = array("q", cid)
+
+    def root(self) -> CompactNode:
+        return CompactNode(self, 0)
+
+    def covered_line_numbers(self, i: int) -> set[int]:
+        r = set()
+        stack = [i]
+        while stack:
+            i = stack.pop()
+            if self.first_line[i] >= 0:
+                r.update(range(self.first_line[i], self.last_line[i] + 1))
+            first = self.first_child[i]
+            stack.extend(range(first, first + self.child_count[i]))
+        return r
+
+
+class CompactChildren:
+    """Read only list of the children of a CompactNode."""
+
+    __slots__ = ("tree", "first", "count")
+
+    def __init__(self, tree: CompactTree, index: int):
+        self.tree = tree
+        self.first = tree.first_child[index]
+        self.count = tree.child_count[index]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return CompactNode(self.tree, self.first + i)
+
+    def __iter__(self):
+        for i in range(self.first, self.first + self.count):
+            yield CompactNode(self.tree, i)
+
+
+class CompactNode(HashMixin, LineMixin, SizeMixin):
+    """A node of a CompactTree with the interface of AbstractSyntaxTree.
+
+    Views are created on access. Only statements, which are kept in statement
+    sequences, live long enough to carry marks, sizes and hashes.
+    """
+
+    __slots__ = (
+        "tree",
+        "index",
+        "mark",
+        "_hash",
+        "_size",
+        "_none_count",
+        "_covered",
+    )
+
+    def __init__(self, tree: CompactTree, index: int):
+        self.tree = tree
+        self.index = index
+        self.mark = None
+        self._hash = None
+        self._size = None
+        self._none_count = 0
+        self._covered = None
+
+    def __repr__(self):
+        return f"<CompactNode {self.name} #{self.index}>"
+
+    @property
+    def name(self) -> str:
+        return self.tree.kinds[self.tree.kind[self.index]]
+
+    @property
+    def childs(self) -> CompactChildren:
+        return CompactChildren(self.tree, self.index)
+
+    @property
+    def parent(self):
+        p = self.tree.parent[self.index]
+        return CompactNode(self.tree, p) if p >= 0 else None
+
+    @parent.setter
+    def parent(self, value):
+        # parsed trees are read only, unification does not need to re-parent them
+        pass
+
+    @property
+    def source_file(self) -> SourceFile:
+        return self.tree.source_file
+
+    @property
+    def _is_statement(self) -> bool:
+        return bool(self.tree.is_statement[self.index])
+
+    @property
+    def _height(self) -> int:
+        return self.tree.height[self.index]
+
+    @property
+    def _cid(self):
+        return self.tree.cid[self.index] if self.tree.cid else None
+
+    def resetCanonicalIds(self):
+        # ids are kept per file, they are assigned again for the whole tree
+        self.tree.cid = None
+
+    def getCanonicalId(self) -> int:
+        self.tree.assignCanonicalIds()
+        return self.tree.cid[self.index]
+
+    @property
+    def _covered_line_numbers(self) -> set[int]:
+        if self._covered is None:
+            self._covered = self.tree.covered_line_numbers(self.index)
+        return self._covered
+
+    def getCoveredLineNumbers(self):
+        return self._covered_line_numbers
+
+    def storeSize(self, free_variable_cost: float):
+        # parsed trees have no free variables, so the size was computed by the tree
+        self._size = self.tree.size[self.index]
+        self._none_count = self.tree.has_none[self.index]
+
+    def propagateHashes(self, depth: int):
+        self.tree.propagateHashes(depth)
+
+    def getFullHash(self):
+        self.tree.propagateHashes(self.hash_depth)
+        return self.tree.full_hash[self.index]
+
+    def getDCupHash(self, level: int):
+        if level < 0:
+            return self.getFullHash()
+        self.tree.propagateHashes(max(level, self.hash_depth))
+        return self.tree.dcup[self.index * (self.tree.hash_depth + 1) + level]
@@ -0,0 +1,74 @@
+from __future__ import annotations
+import os
+from clonedigger.backend.ast_wrapper import StatementSequence
+
+
+class LineCoverage:
+    """Lines of source files covered by statement sequences.
+
+    Each file has a bytearray indexed by line number, filled in place from
+    the lines of the statements, whole ranges at a time where they have no
+    gaps.
+    """
+
+    def __init__(self):
+        self._lines = {}  # file name -> bytearray, 1 for a covered line
+
+    def add(self, sequence: StatementSequence):
+        source_file = sequence.source_file
+        lines = self._lines.get(source_file.file_name)
+        if lines is None:
+            lines = self._lines[source_file.file_name] = bytearray(len(source_file))
+        for statement in sequence:
+            covered = statement.getCoveredLineNumbers()
+            if not covered:
+                continue
+            first, last = min(covered), max(covered)
+            if last >= len(lines):
+                lines.extend(bytes(last + 1 - len(lines)))
+            if last - first + 1 == len(covered):
+                lines[first : last + 1] = b"\x01" * len(covered)
+            else:
+                for line in covered:
+                    lines[line] = 1
+
+    def __len__(self):
+        return sum(lines.count(1) for lines in self._lines.values())
+
+    def counts(self) -> dict[str, int]:
+        return {str(file_name): lines.count(1) for file_name, lines in self._lines.items()}
+
+    def percentages(self, total: LineCoverage) -> tuple[dict[str, float], dict[str, float]]:
+        """Percentages of the lines of total that are covered here, per file and per directory."""
+        return self.percentages_of(total.counts())
+
+    def percentages_of(self, total_counts: dict[str, int]) -> tuple[dict, dict]:
+        """Same as percentages, from the counts of covered lines per file of total.
+
+        The lines of a file count in its directory and in every directory
+        above it, up to the one common to all files.
+        """
+        covered = self.counts()
+        total_counts = {f: n for f, n in total_counts.items() if n}
+        files = {}
+        directories = {}
+        root = _common_directory(total_counts)
+        for file_name, count in total_counts.items():
+            files[file_name] = 100 * covered.get(file_name, 0) / count
+            directory = os.path.dirname(file_name)
+            while True:
+                lines = directories.setdefault(directory, [0, 0])
+                lines[0] += covered.get(file_name, 0)
+                lines[1] += count
+                parent = os.path.dirname(directory)
+                if directory == root or parent == directory:
+                    break
+                directory = parent
+        return files, {d: 100 * c / n for d, (c, n) in directories.items()}
+
+
+def _common_directory(file_names) -> str:
+    try:
+        return os.path.commonpath([os.path.dirname(e) for e in file_names])
+    except ValueError:  # no files, or absolute and relative names mixed
+        return ""
@@ -0,0 +1,431 @@
+from __future__ import annotations
+import hashlib
+import heapq
+import itertools
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from clonedigger.backend.ast_wrapper import (
+    SourceFile,
+    StatementSequence,
+    canonical_id_count,
+    clear_canonical_ids,
+)
+from clonedigger.backend.clone_detection_algorithm import (
+    PairSequences,
+    kept_statement_ranges,
+    refine_duplicate_candidates,
+    remove_dominated_clones,
+    unification_cache,
+)
+from clonedigger.backend.compact_tree import CompactTree
+from clonedigger.backend.line_coverage import LineCoverage
+from clonedigger.backend.suffix_array import SuffixArray
+from clonedigger.instrumentation import Instrumentation
+from clonedigger.settings import Settings, logger
+
+RECORD_BYTES = 200  # rough size of a buffered record tuple
+TREE_BYTES = 50  # rough memory of compact trees per byte of source
+CANONICAL_ID_BYTES = 200  # rough size of an entry of the canonical id table
+DIGEST_BYTES = 16
+
+
+class SortedRuns:
+    """External sort of fixed size integer records.
+
+    Records are buffered in memory and written to disk as sorted runs
+    whenever the buffer is full, `merged` streams all of them in order.
+    """
+
+    def __init__(self, directory: Path, fmt: str, buffer_size: int):
+        self.directory = Path(directory)
+        self.record = struct.Struct(fmt)
+        self.buffer_size = max(buffer_size, 1)
+        self.buffer = []
+        self.runs = []
+
+    def __len__(self):
+        return len(self.runs) * self.buffer_size + len(self.buffer)
+
+    def add(self, record: tuple):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort()
+        path = self.directory / f"run-{id(self)}-{len(self.runs)}"
+        with open(path, "wb") as f:
+            for i in range(0, len(self.buffer), 4096):
+                f.write(b"".join(self.record.pack(*e) for e in self.buffer[i : i + 4096]))
+        self.runs.append(path)
+        self.buffer = []
+
+    def _read(self, path: Path):
+        chunk = self.record.size * 4096
+        with open(path, "rb") as f:
+            while data := f.read(chunk):
+                yield from self.record.iter_unpack(data)
+        os.unlink(path)
+
+    def merged(self):
+        self.buffer.sort()
+        return heapq.merge(*map(self._read, self.runs), self.buffer)
+
+
+class LineStore:
+    """Covered lines of numbered statements, in a file that is read back on demand."""
+
+    def __init__(self, path: Path):
+        self._file = open(path, "w+b")
+        self.offsets = array("q")
+        self.counts = array("i")
+        self._size = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, lines) -> int:
+        data = array("i", sorted(lines))
+        self._file.seek(4 * self._size)
+        self._file.write(data.tobytes())
+        self.offsets.append(self._size)
+        self.counts.append(len(data))
+        self._size += len(data)
+        return len(self.offsets) - 1
+
+    def get(self, n: int) -> array:
+        data = array("i", bytes(4 * self.counts[n]))
+        self._file.seek(4 * self.offsets[n])
+        self._file.readinto(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class StatementLines:
+    """A statement of a clone without its tree: its lines and identity.
+
+    Equality is that of the statement, by the digest of its tree, so
+    remove_dominated_clones and the reports treat these like the statements. Statements of parsed
+    files report no ancestors, their parents are tree nodes, neither do these.
+    """
+
+    __slots__ = ("source_file", "digest", "_lines")
+
+    def __init__(self, source_file: SourceFile, digest: bytes, lines: array):
+        self.source_file = source_file
+        self.digest = digest
+        self._lines = lines
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __eq__(self, other):
+        return isinstance(other, StatementLines) and self.digest == other.digest
+
+    def getCoveredLineNumbers(self) -> set[int]:
+        return set(self._lines)
+
+    def getAncestors(self) -> list:
+        return []
+
+    def as_string(self) -> str:
+        return "\n".join(self.source_file.getLines(self._lines))
+
+
+class TreeLoader:
+    """Statement sequences of files, parsed again on demand and kept while they fit.
+
+    Canonical ids of the kept trees come from the process-wide table, which
+    is cleared by reset_canonical_ids when it outgrows its share of the budget.
+    """
+
+    def __init__(self, fps: list[Path], func_prefixes, cfg, budget: int, cache=None):
+        self.fps = fps
+        self.func_prefixes = func_prefixes
+        self.cfg = cfg
+        self.budget = budget
+        self.cache = cache
+        self._files = OrderedDict()  # file index -> (statement sequences, estimated bytes)
+        self.loads = 0
+
+    def estimate(self, i: int) -> int:
+        return self.fps[i].stat().st_size * TREE_BYTES
+
+    def get(self, i: int, keep=()) -> list:
+        if i in self._files:
+            self._files.move_to_end(i)
+            return self._files[i][0]
+        from clonedigger.main import parse_file  # main imports this module
+
+        source_file = parse_file(self.fps[i], self.func_prefixes, self.cfg, self.cache)
+        sequences = source_file.statement_sequences
+        self.loads += 1
+        self._files[i] = sequences, self.estimate(i)
+        used = sum(e[1] for e in self._files.values())
+        for j in list(self._files):
+            if used <= self.budget:
+                break
+            if j != i and j not in keep:
+                used -= self._files.pop(j)[1]
+        return sequences
+
+    def reset_canonical_ids(self):
+        # the unification cache is keyed by ids, kept trees get new ones on demand
+        unification_cache.clear(self.cfg.unification_cache_size)
+        clear_canonical_ids()
+        for sequences, _ in self._files.values():
+            for sequence in sequences:
+                for statement in sequence:
+                    statement.resetCanonicalIds()
+
+
+def structure_digests(tree: CompactTree) -> list[bytes]:
+    """A digest of each subtree, equal for structurally equal subtrees.
+
+    Unlike canonical ids these need no table, so statements of all files
+    can be compared while only one file is parsed at a time.
+    """
+    names = [len(e).to_bytes(4, "little") + e for e in (e.encode() for e in tree.kinds)]
+    digests = [b""] * len(tree)
+    for i in range(len(tree) - 1, -1, -1):
+        first = tree.first_child[i]
+        children = b"".join(digests[first : first + tree.child_count[i]]) if first >= 0 else b""
+        digests[i] = hashlib.blake2b(
+            names[tree.kind[i]] + children, digest_size=DIGEST_BYTES
+        ).digest()
+    return digests
+
+
+def _statement_hash(statement, cfg) -> int:
+    if cfg.clusterize_using_hash:
+        return statement.getFullHash()
+    return statement.getDCupHash(cfg.hashing_depth)
+
+
+def main(fps: list[Path], func_prefixes, cfg, instrumentation: Instrumentation = None):
+    """Same result as clone_detection_algorithm.main with hash marks, in bounded memory.
+
+    Parsed trees are only kept for one file at a time. Statements are
+    numbered across files; their marks, one int each, the digests of their
+    trees and the suffix array over the marks stay in memory, their covered lines go
+    to a LineStore on disk. Candidates whose statements are pairwise equal
+    are exact clones and need no trees, the others are spilled to sorted
+    runs and refined in batches, for which trees are parsed again. The
+    canonical id table only holds the trees of recent batches. Clones keep
+    only the lines of their statements.
+    """
+    from clonedigger.main import open_parse_cache, parse_file  # main imports this module
+
+    instrumentation = instrumentation or Instrumentation()
+    unification_cache.clear(cfg.unification_cache_size)
+    clear_canonical_ids()  # trees are parsed in this run, none has an id yet
+    limit = cfg.memory_limit * 2**20
+    buffer_size = limit // 8 // RECORD_BYTES
+    with tempfile.TemporaryDirectory(prefix="clonedigger-") as directory:
+        # files are parsed to compact trees, which are quick to load from a
+        # parse cache, a private one unless there is one
+        parse_cfg = Settings(
+            **{
+                **cfg.model_dump(),
+                "compact_trees": True,
+                "cache_dir": cfg.cache_dir or os.path.join(directory, "cache"),
+            }
+        )
+        cache = open_parse_cache(parse_cfg)
+        fingerprints = SortedRuns(directory, "<qqi", buffer_size)
+        lines = LineStore(Path(directory) / "lines")
+        digests = bytearray()  # DIGEST_BYTES per statement
+        source_files = []
+        sequence_starts = []  # per file, the number of the first statement of each sequence
+        segments = []  # (file, sequence, first, end) of the sequences clones are searched in
+        source_lines = LineCoverage()
+        with instrumentation.phase("fingerprints"):
+            for i, fp in enumerate(fps):
+                source_file = parse_file(fp, func_prefixes, parse_cfg, cache)
+                source_files.append(source_file._source_file)
+                sequences = source_file.statement_sequences
+                tree_digests = []
+                if sequences and sequences[0]:
+                    tree_digests = structure_digests(sequences[0][0].tree)
+                sequence_starts.append(array("q"))
+                for k, sequence in enumerate(sequences):
+                    sequence_starts[i].append(len(lines))
+                    hashes = [_statement_hash(s, cfg) for s in sequence]
+                    for statement, statement_hash in zip(sequence, hashes):
+                        covered = statement.getCoveredLineNumbers()
+                        fingerprints.add((statement_hash, lines.add(covered), len(covered)))
+                        digests += tree_digests[statement.index]
+                    ranges = [(0, len(sequence))]
+                    if not cfg.force:
+                        ranges = kept_statement_ranges(hashes, sequence)
+                    for first, end in ranges:
+                        segments.append((i, k, first, end))
+                        source_lines.add(StatementSequence(sequence[first:end]))
+                del source_file, sequences, tree_digests
+        instrumentation.count("files", len(fps))
+        instrumentation.count("statements", len(lines))
+        instrumentation.count("fingerprint_runs", len(fingerprints.runs))
+        if not segments:
+            logger.error("Input is empty or the size of the input is below the size threshold")
+            sys.exit(0)
+
+        with instrumentation.phase("marks"):
+            # buckets are numbered from 1 in the order of their hashes
+            marks = array("i", bytes(4 * len(lines)))
+            bucket_lines = array("i", [0])
+            bucket_sizes = []
+            for _, group in itertools.groupby(fingerprints.merged(), key=lambda e: e[0]):
+                bucket = len(bucket_lines)
+                most_lines = size = 0
+                for _, g, statement_lines in group:
+                    marks[g] = bucket
+                    most_lines = max(most_lines, statement_lines)
+                    size += 1
+                bucket_lines.append(most_lines)
+                bucket_sizes.append(size)
+        instrumentation.count("hash_buckets", len(bucket_sizes))
+        instrumentation.histogram("hash_bucket_sizes", bucket_sizes)
+        del bucket_sizes
+
+        def stand_ins(i: int, g: int, length: int) -> StatementSequence:
+            return StatementSequence(
+                [
+                    StatementLines(source_files[i], statement_digest(e), lines.get(e))
+                    for e in range(g, g + length)
+                ]
+            )
+
+        def statement_digest(g: int) -> bytes:
+            return bytes(digests[g * DIGEST_BYTES : (g + 1) * DIGEST_BYTES])
+
+        def equal_statements(g1: int, g2: int, length: int) -> bool:
+            d1, d2, n = g1 * DIGEST_BYTES, g2 * DIGEST_BYTES, length * DIGEST_BYTES
+            return digests[d1 : d1 + n] == digests[d2 : d2 + n]
+
+        def covered_count(g: int, length: int) -> int:
+            covered = set()
+            for e in range(g, g + length):
+                covered.update(lines.get(e))
+            return len(covered)
+
+        # clones are keyed by the order of an in-memory run, where candidates
+        # are refined as they are found
+        clones = []
+        # batches are unordered pairs of files, sorted by the blocks of the
+        # files: blocks fit in half the budget for trees, so each block pair
+        # is refined with every file of it parsed once, as in a block nested
+        # loop join
+        loader = TreeLoader(fps, func_prefixes, parse_cfg, limit // 2, cache)
+        blocks = array("i")
+        block = block_bytes = 0
+        for i in range(len(fps)):
+            if block_bytes and block_bytes + loader.estimate(i) > loader.budget // 2:
+                block += 1
+                block_bytes = 0
+            block_bytes += loader.estimate(i)
+            blocks.append(block)
+        candidates = SortedRuns(directory, "<iiiiqiiiiiii", buffer_size)
+        with instrumentation.phase("find_sequences"):
+            suffix_array = SuffixArray(lambda x: x)
+            for i, k, first, end in segments:
+                g = sequence_starts[i][k] + first
+                suffix_array.add(marks[g : g + end - first])
+            del marks
+            for n, (q1, q2, length) in enumerate(
+                suffix_array.getBestMaxPositions(cfg.size_threshold, bucket_lines.__getitem__)
+            ):
+                s1, offset1 = suffix_array.getPosition(q1)
+                s2, offset2 = suffix_array.getPosition(q2)
+                i1, k1, first1, _ = segments[s1]
+                i2, k2, first2, _ = segments[s2]
+                first1 += offset1
+                first2 += offset2
+                g1 = sequence_starts[i1][k1] + first1
+                g2 = sequence_starts[i2][k2] + first2
+                # as in find_sequences, bucket lines only bound those of the statements
+                sizes = covered_count(g1, length), covered_count(g2, length)
+                if max(sizes) < cfg.size_threshold:
+                    continue
+                if equal_statements(g1, g2, length) and cfg.distance_threshold > 0:
+                    # windows cover no more lines than the whole candidate
+                    instrumentation.count("exact_candidates")
+                    if min(sizes) >= cfg.size_threshold:
+                        clone = PairSequences(
+                            [stand_ins(i1, g1, length), stand_ins(i2, g2, length)], cfg=cfg
+                        )
+                        clone.distance = 0
+                        clone.row_differences = [False] * length
+                        clones.append(((n, 0), clone))
+                    continue
+                lo, hi = min(i1, i2), max(i1, i2)
+                candidates.add(
+                    (blocks[lo], blocks[hi], lo, hi, n, i1, k1, first1, i2, k2, first2, length)
+                )
+            instrumentation.count("lcp_intervals", suffix_array.intervals)
+            del suffix_array, segments
+        instrumentation.count("candidates", len(candidates))
+        instrumentation.count("candidate_runs", len(candidates.runs))
+
+        with instrumentation.phase("refine_batches"):
+            batches = itertools.groupby(candidates.merged(), key=lambda e: e[:4])
+            for (_, _, lo, hi), batch in batches:
+                instrumentation.count("batches")
+                if canonical_id_count() > limit // 8 // CANONICAL_ID_BYTES:
+                    instrumentation.count("canonical_id_resets")
+                    loader.reset_canonical_ids()
+                loaded = {lo: loader.get(lo, keep=(hi,)), hi: loader.get(hi, keep=(lo,))}
+                for *_, n, i1, k1, first1, i2, k2, first2, length in batch:
+                    candidate = PairSequences(
+                        [
+                            StatementSequence(loaded[i1][k1][first1 : first1 + length]),
+                            StatementSequence(loaded[i2][k2][first2 : first2 + length]),
+                        ],
+                        cfg=cfg,
+                    )
+                    offsets = {id(s): j for j, s in enumerate(candidate[0])}
+                    found = [candidate]
+                    if cfg.distance_threshold != -1:
+                        found = refine_duplicate_candidates([candidate], cfg)
+                    for m, clone in enumerate(found):
+                        clone.storeDistances()
+                        g1 = sequence_starts[i1][k1] + first1 + offsets[id(clone[0][0])]
+                        g2 = sequence_starts[i2][k2] + first2 + offsets[id(clone[0][0])]
+                        light = PairSequences(
+                            [stand_ins(i1, g1, len(clone[0])), stand_ins(i2, g2, len(clone[1]))],
+                            cfg=cfg,
+                        )
+                        light.distance = clone.distance
+                        light.row_differences = clone.row_differences
+                        clones.append(((n, m), light))
+        instrumentation.count("tree_loads", loader.loads)
+        del loader
+        lines.close()
+    clones.sort(key=lambda e: e[0])
+    clones = [e[1] for e in clones]
+    instrumentation.count("refined_clones", len(clones))
+    if cfg.distance_threshold != -1:
+        with instrumentation.phase("remove_dominated_clones"):
+            clones = remove_dominated_clones(clones)
+    instrumentation.count("clones", len(clones))
+
+    with instrumentation.phase("coverage"):
+        covered_source_lines = LineCoverage()
+        for clone in clones:
+            for sequence in clone:
+                covered_source_lines.add(sequence)
+        file_coverage, directory_coverage = covered_source_lines.percentages(source_lines)
+    return dict(
+        clones=clones,
+        mark_to_statement_hash=None,
+        all_source_lines_count=len(source_lines),
+        covered_source_lines_count=len(covered_source_lines),
+        file_coverage=file_coverage,
+        directory_coverage=directory_coverage,
+    )
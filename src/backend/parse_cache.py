@@ -0,0 +1,90 @@
+from __future__ import annotations
+import hashlib
+import os
+import pickle
+import sys
+import zlib
+from pathlib import Path
+from clonedigger.settings import logger
+
+
+class ParseCache:
+    """Content addressed on-disk store of parsed and fingerprinted files.
+
+    An entry is keyed by the file content and by the settings that affect
+    statement sequences, sizes and hashes, so it never has to be invalidated.
+    The least recently used entries are removed once the directory grows
+    over `size_limit` bytes.
+    """
+
+    version = 5
+    suffix = ".pickle.z"
+
+    def __init__(self, directory: Path, size_limit: int = 1024 * 2**20):
+        self.directory = Path(directory)
+        self.size_limit = size_limit
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, data: bytes, cfg, func_prefixes=()) -> str:
+        h = hashlib.sha256(data)
+        h.update(
+            repr(
+                (
+                    self.version,
+                    sys.version_info[:2],
+                    cfg.hashing_depth,
+                    cfg.size_threshold,
+                    cfg.free_variable_cost,
+                    cfg.compact_trees,
+                    list(func_prefixes),
+                )
+            ).encode()
+        )
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / (key + self.suffix)
+
+    def load(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                source_file = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning(f"Dropping broken cache entry {path}")
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)  # mtime is the last access time for eviction
+        return source_file
+
+    def store(self, key: str, source_file):
+        try:
+            data = zlib.compress(pickle.dumps(source_file, pickle.HIGHEST_PROTOCOL))
+        except RecursionError:
+            logger.debug(f"{source_file._source_file.file_name} is too deep to be cached")
+            return
+        path = self._path(key)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith(self.suffix):
+                    st = e.stat()
+                    entries.append((st.st_mtime, st.st_size, e.path))
+                    total += st.st_size
+        if total <= self.size_limit:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.size_limit:
+                break
+            os.unlink(path)
+            total -= size
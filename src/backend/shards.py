@@ -0,0 +1,193 @@
+from __future__ import annotations
+import itertools
+import sys
+from array import array
+from pathlib import Path
+from clonedigger.backend.ast_wrapper import StatementSequence, clear_canonical_ids
+from clonedigger.backend.clone_detection_algorithm import (
+    PairSequences,
+    assign_canonical_ids,
+    calc_statement_sizes,
+    kept_statement_ranges,
+    refine_duplicate_candidates,
+    remove_dominated_clones,
+    unification_cache,
+)
+from clonedigger.backend.clone_index import CloneIndex
+from clonedigger.backend.line_coverage import LineCoverage
+from clonedigger.backend.suffix_array import SuffixArray
+from clonedigger.instrumentation import Instrumentation
+from clonedigger.settings import logger
+
+
+def merge(index_paths: list[Path], func_prefixes, cfg, instrumentation: Instrumentation = None):
+    """Clones of the files of shard indexes, as one scan of all the files finds them.
+
+    Shards are clone indexes written by separate scans, --shard-index or
+    --index. Clones within a shard are read from its index. A clone across
+    shards only pairs statements of hash buckets found in several shards, so
+    the suffix array is built from the marks in the indexes with the other
+    statements as separators, and only candidates between files of different
+    shards are refined. Files are parsed again only if they have clones.
+    """
+    instrumentation = instrumentation or Instrumentation()
+    unification_cache.clear(cfg.unification_cache_size)
+    clear_canonical_ids()  # trees are parsed in this run, none has an id yet
+    if not (cfg.clusterize_using_dcup or cfg.clusterize_using_hash):
+        logger.error("Merging shards needs hash based marks")
+        sys.exit(1)
+    indexes = [CloneIndex(path, readonly=True, func_prefixes=func_prefixes) for path in index_paths]
+    try:
+        return _merge(indexes, func_prefixes, cfg, instrumentation)
+    finally:
+        for index in indexes:
+            index.close()
+
+
+def _merge(indexes: list[CloneIndex], func_prefixes, cfg, instrumentation: Instrumentation):
+    from clonedigger.main import parse_files  # main imports this module
+
+    with instrumentation.phase("load_shards"):
+        shard_of = {}  # file name -> number of the shard it is taken from
+        digests = {}
+        source_line_counts = {}
+        for n, index in enumerate(indexes):
+            if not index.matches(cfg):
+                logger.error(f"{index.path} was written with other settings or --func-prefixes")
+                sys.exit(1)
+            for path, digest, source_lines in index.files():
+                if path in shard_of:
+                    logger.warning(
+                        f"{path} is in {indexes[shard_of[path]].path} and {index.path}, "
+                        f"the first one is used"
+                    )
+                    continue
+                shard_of[path] = n
+                digests[path] = digest
+                source_line_counts[path] = source_lines
+
+        # buckets are numbered from 1, shared ones have statements in several shards
+        buckets = {}
+        bucket_lines = array("i", [0])  # the most lines a statement of the bucket covers
+        bucket_shard = array("i", [-1])
+        shared = bytearray(1)
+        sequences = []  # (file name, sequence, buckets of the statements)
+        for n, index in enumerate(indexes):
+            for (path, k), rows in itertools.groupby(index.statement_marks(), key=lambda e: e[:2]):
+                if shard_of[path] != n:
+                    continue
+                codes = array("i")
+                for *_, mark, line_count in rows:
+                    bucket = buckets.get(mark)
+                    if bucket is None:
+                        bucket = buckets[mark] = len(bucket_lines)
+                        bucket_lines.append(0)
+                        bucket_shard.append(n)
+                        shared.append(0)
+                    elif bucket_shard[bucket] != n:
+                        shared[bucket] = 1
+                    bucket_lines[bucket] = max(bucket_lines[bucket], line_count)
+                    codes.append(bucket)
+                sequences.append((path, k, codes))
+    instrumentation.count("shards", len(indexes))
+    instrumentation.count("files", len(shard_of))
+    instrumentation.count("statements", sum(len(e[2]) for e in sequences))
+    instrumentation.count("hash_buckets", len(buckets))
+    instrumentation.count("shared_hash_buckets", shared.count(1))
+
+    candidates = []
+    with instrumentation.phase("find_sequences"):
+        segments = []  # (sequence, first, end)
+        for s, (_, _, codes) in enumerate(sequences):
+            ranges = [(0, len(codes))] if cfg.force else kept_statement_ranges(codes)
+            for first, end in ranges:
+                start = first
+                for j in range(first, end + 1):
+                    if j == end or not shared[codes[j]]:
+                        if j > start:
+                            segments.append((s, start, j))
+                        start = j + 1
+        suffix_array = SuffixArray(lambda x: x)
+        for s, first, end in segments:
+            suffix_array.add(sequences[s][2][first:end])
+        for q1, q2, length in suffix_array.getBestMaxPositions(
+            cfg.size_threshold, bucket_lines.__getitem__
+        ):
+            ends = []
+            for q in (q1, q2):
+                segment, offset = suffix_array.getPosition(q)
+                s, first, _ = segments[segment]
+                ends.append((sequences[s][0], sequences[s][1], first + offset))
+            if shard_of[ends[0][0]] != shard_of[ends[1][0]]:
+                candidates.append((ends, length))
+        instrumentation.count("lcp_intervals", suffix_array.intervals)
+    instrumentation.count("candidates", len(candidates))
+
+    with instrumentation.phase("parse"):
+        needed = {path for ends, _ in candidates for path, _, _ in ends}
+        for index in indexes:
+            needed |= index.clone_files()
+        names = sorted(needed & shard_of.keys())
+        files = {}
+        for path, source_file in zip(
+            names, parse_files([Path(e) for e in names], func_prefixes, jobs=cfg.jobs, cfg=cfg)
+        ):
+            if source_file.digest != digests[path]:
+                logger.warning(
+                    f"{path} changed since its shard was scanned, its clones are left out"
+                )
+                continue
+            files[path] = source_file
+        statement_sequences = [s for e in files.values() for s in e.statement_sequences]
+        calc_statement_sizes(statement_sequences, cfg)
+        assign_canonical_ids(statement_sequences)
+    instrumentation.count("parsed_files", len(files))
+
+    with instrumentation.phase("shard_clones"):
+        clones = []
+        for n, index in enumerate(indexes):
+            shard_files = [e for path, e in files.items() if shard_of[path] == n]
+            clones += index.load_clones(shard_files, set(), cfg)
+    instrumentation.count("shard_clones", len(clones))
+
+    def pairs():
+        for ends, length in candidates:
+            if all(path in files for path, _, _ in ends):
+                yield PairSequences(
+                    [
+                        StatementSequence(
+                            files[path].statement_sequences[k][first : first + length]
+                        )
+                        for path, k, first in ends
+                    ],
+                    cfg=cfg,
+                )
+
+    with instrumentation.phase("refine"):
+        if cfg.distance_threshold != -1:
+            cross_clones = refine_duplicate_candidates(pairs(), cfg)
+        else:
+            cross_clones = list(pairs())
+    instrumentation.count("cross_shard_clones", len(cross_clones))
+    clones += cross_clones
+    if cfg.distance_threshold != -1:
+        with instrumentation.phase("remove_dominated_clones"):
+            clones = remove_dominated_clones(clones)
+    instrumentation.count("clones", len(clones))
+
+    with instrumentation.phase("distances_and_coverage"):
+        covered_source_lines = LineCoverage()
+        for clone in clones:
+            clone.storeDistances()
+            for sequence in clone:
+                covered_source_lines.add(sequence)
+        file_coverage, directory_coverage = covered_source_lines.percentages_of(source_line_counts)
+    return dict(
+        clones=clones,
+        mark_to_statement_hash=None,
+        all_source_lines_count=sum(source_line_counts.values()),
+        covered_source_lines_count=len(covered_source_lines),
+        file_coverage=file_coverage,
+        directory_coverage=directory_coverage,
+        file_names=[Path(e) for e in shard_of],
+    )
@@ -0,0 +1,222 @@
+from __future__ import annotations
+from array import array
+from collections.abc import Callable, Iterator
+
+
+def suffix_array(s: list[int], upper: int) -> list[int]:
+    """Suffix array of s, whose values are in 0..upper, by induced sorting (SA-IS)."""
+    n = len(s)
+    if n < 10:
+        return sorted(range(n), key=lambda i: s[i:])
+    sa = [0] * n
+    ls = [False] * n  # S-type suffixes
+    for i in range(n - 2, -1, -1):
+        ls[i] = ls[i + 1] if s[i] == s[i + 1] else s[i] < s[i + 1]
+    sum_l = [0] * (upper + 1)
+    sum_s = [0] * (upper + 1)
+    for i in range(n):
+        if not ls[i]:
+            sum_s[s[i]] += 1
+        else:
+            sum_l[s[i] + 1] += 1
+    for i in range(upper + 1):
+        sum_s[i] += sum_l[i]
+        if i < upper:
+            sum_l[i + 1] += sum_s[i]
+
+    def induce(lms):
+        for i in range(n):
+            sa[i] = -1
+        buf = sum_s[:]
+        for d in lms:
+            if d != n:
+                sa[buf[s[d]]] = d
+                buf[s[d]] += 1
+        buf = sum_l[:]
+        sa[buf[s[n - 1]]] = n - 1
+        buf[s[n - 1]] += 1
+        for i in range(n):
+            v = sa[i]
+            if v >= 1 and not ls[v - 1]:
+                sa[buf[s[v - 1]]] = v - 1
+                buf[s[v - 1]] += 1
+        buf = sum_l[:]
+        for i in range(n - 1, -1, -1):
+            v = sa[i]
+            if v >= 1 and ls[v - 1]:
+                buf[s[v - 1] + 1] -= 1
+                sa[buf[s[v - 1] + 1]] = v - 1
+
+    lms_map = [-1] * (n + 1)
+    lms = []
+    for i in range(1, n):
+        if not ls[i - 1] and ls[i]:
+            lms_map[i] = len(lms)
+            lms.append(i)
+    m = len(lms)
+    induce(lms)
+    if m:
+        # name the LMS substrings and sort them recursively
+        sorted_lms = [v for v in sa if lms_map[v] != -1]
+        rec_s = [0] * m
+        rec_upper = 0
+        for i in range(1, m):
+            left, right = sorted_lms[i - 1], sorted_lms[i]
+            end_l = lms[lms_map[left] + 1] if lms_map[left] + 1 < m else n
+            end_r = lms[lms_map[right] + 1] if lms_map[right] + 1 < m else n
+            same = end_l - left == end_r - right
+            if same:
+                while left < end_l and s[left] == s[right]:
+                    left += 1
+                    right += 1
+                same = left != n and s[left] == s[right]
+            if not same:
+                rec_upper += 1
+            rec_s[lms_map[sorted_lms[i]]] = rec_upper
+        rec_sa = suffix_array(rec_s, rec_upper)
+        induce([lms[e] for e in rec_sa])
+    return sa
+
+
+def lcp_array(s: list[int], sa: list[int]) -> list[int]:
+    """lcp[i] is the longest common prefix of suffixes sa[i - 1] and sa[i] (Kasai)."""
+    n = len(s)
+    rank = [0] * n
+    for i, p in enumerate(sa):
+        rank[p] = i
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        r = rank[i]
+        if r == 0:
+            h = 0
+            continue
+        j = sa[r - 1]
+        while i + h < n and j + h < n and s[i + h] == s[j + h]:
+            h += 1
+        lcp[r] = h
+        if h:
+            h -= 1
+    return lcp
+
+
+class SuffixArray:
+    """Maximal repeated pairs of subsequences of several sequences.
+
+    Elements are mapped to integer codes with f_code and the sequences are
+    concatenated with a unique separator after each one. The suffix array and
+    the LCP array of the text give the nodes of its suffix tree as LCP
+    intervals without building it, in linear space. Positions of the text are
+    (sequence, offset) pairs, subsequences are sliced only for the reported
+    pairs.
+    """
+
+    def __init__(self, f_code: Callable):
+        self._f_code = f_code
+        self._sequences = []
+        self._sequence_index = array("i")  # sequence and offset of each text position
+        self._offsets = array("i")
+        self.intervals = 0  # LCP intervals visited, the internal nodes of the suffix tree
+
+    def add(self, sequence):
+        self._sequences.append(sequence)
+
+    def _build(self, f):
+        codes = {}
+        text = []
+        weights = [0]
+        prev = []  # code of the previous element, None at the start of a sequence
+        sequence_index = array("i")
+        offsets = array("i")
+        for k, sequence in enumerate(self._sequences):
+            previous = None
+            for i, e in enumerate(sequence):
+                code = self._f_code(e)
+                if code not in codes:
+                    codes[code] = len(codes)
+                text.append(codes[code])
+                weights.append(weights[-1] + f(code))
+                prev.append(codes[previous] if previous else None)
+                previous = code
+                sequence_index.append(k)
+                offsets.append(i)
+            text.append(-1 - k)
+            weights.append(weights[-1])
+            prev.append(None)
+            sequence_index.append(k)
+            offsets.append(len(sequence))
+        # separators take the values after the codes, one per sequence
+        upper = len(codes) + len(self._sequences) - 1
+        text = [e if e >= 0 else len(codes) - 1 - e for e in text]
+        self._sequence_index = sequence_index
+        self._offsets = offsets
+        return text, upper, weights, prev, len(codes)
+
+    def getBestMaxSubstrings(self, threshold, f: Callable) -> Iterator[tuple[list, list]]:
+        """Slices of the sequences for the pairs of getBestMaxPositions."""
+        for q1, q2, length in self.getBestMaxPositions(threshold, f):
+            yield self._slice(q1, length), self._slice(q2, length)
+
+    def getBestMaxPositions(self, threshold, f: Callable) -> Iterator[tuple[int, int, int]]:
+        """Pairs of occurrences of repeats that can not be extended in either direction.
+
+        A pair is reported for every two occurrences of a repeat that are
+        followed by different elements (or the end of a sequence) and preceded
+        by different elements (or the start of a sequence), if the sum of f
+        over the codes of the repeat is at least threshold. In each pair the
+        first occurrence is the one ending there, or else the later one.
+        Pairs are generated while the LCP intervals are visited, only the
+        stack of open intervals is kept. Occurrences are text positions, see
+        getPosition, followed by the length of the repeat.
+        """
+        if not self._sequences:
+            return
+        text, upper, weights, prev, n_codes = self._build(f)
+        sa = suffix_array(text, upper)
+        lcp = lcp_array(text, sa)
+        n = len(text)
+
+        def report(ell, lb, rb, splits):
+            p = sa[lb]
+            if weights[p + ell] - weights[p] < threshold:
+                return
+            children = []
+            bounds = [lb] + splits + [rb + 1]
+            for a, b in zip(bounds, bounds[1:]):
+                positions = sa[a:b]
+                ending = b - a == 1 and text[positions[0] + ell] >= n_codes
+                groups = {}
+                for q in positions:
+                    groups.setdefault(prev[q], []).append(q)
+                children.append(((ending, min(positions)), groups))
+            children.sort(key=lambda x: x[0])
+            for i in range(len(children)):
+                for j in range(i):
+                    for c1, qs1 in children[i][1].items():
+                        for c2, qs2 in children[j][1].items():
+                            if c1 == c2 and c1 is not None:
+                                continue  # the repeat extends to the left
+                            for q1 in qs1:
+                                for q2 in qs2:
+                                    yield q1, q2, ell
+
+        stack = [[0, 0, []]]  # lcp value, left bound, child boundaries
+        for i in range(1, n + 1):
+            ell = lcp[i] if i < n else 0
+            lb = i - 1
+            while ell < stack[-1][0]:
+                top_ell, lb, splits = stack.pop()
+                self.intervals += 1
+                yield from report(top_ell, lb, i - 1, splits)
+            if ell > stack[-1][0]:
+                stack.append([ell, lb, [i]])
+            elif ell == stack[-1][0] and ell > 0:
+                stack[-1][2].append(i)
+
+    def getPosition(self, q: int) -> tuple[int, int]:
+        """Index of the sequence and offset in it of a text position."""
+        return self._sequence_index[q], self._offsets[q]
+
+    def _slice(self, q: int, length: int) -> list:
+        first = self._offsets[q]
+        return self._sequences[self._sequence_index[q]][first : first + length]
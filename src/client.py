@@ -0,0 +1,24 @@
+from __future__ import annotations
+import json
+import socket
+from pathlib import Path
+
+DEFAULT_SOCKET = ".clonedigger.sock"
+
+
+def request(socket_path: Path, message: dict, timeout: float = None) -> dict:
+    """Send one message to a `clonedigger serve` daemon and return its response.
+
+    Messages and responses are JSON objects, one per line. This module only
+    needs the standard library, so asking the daemon costs little more than
+    starting Python.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(str(socket_path))
+        s.sendall(json.dumps(message).encode() + b"\n")
+        with s.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError(f"{socket_path} closed the connection without a response")
+    return json.loads(line)
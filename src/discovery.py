@@ -0,0 +1,153 @@
+from __future__ import annotations
+import os
+import re
+from pathlib import Path
+from typing import Iterable, Iterator
+from clonedigger.settings import logger
+
+# pruned unless a later pattern such as "!node_modules/" includes them again
+DEFAULT_EXCLUDES = [
+    ".git/",
+    ".hg/",
+    ".svn/",
+    "__pycache__/",
+    "node_modules/",
+    ".tox/",
+    ".nox/",
+    ".mypy_cache/",
+    ".pytest_cache/",
+]
+
+
+class ExcludePatterns:
+    """Exclude patterns with the syntax of .gitignore files.
+
+    A pattern without a slash matches a name at any depth, one with a slash
+    matches the path relative to the scanned directory. "*" and "?" do not
+    match slashes, "**" matches any number of directories, a trailing slash
+    only matches directories and a leading "!" includes again what earlier
+    patterns exclude; the last matching pattern wins.
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        self.patterns = []  # (regex, negated, directories only, matched against the path)
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern: str):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith("#"):
+            return
+        negated = pattern.startswith("!")
+        if negated:
+            pattern = pattern[1:]
+        directories_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        regex = re.compile(_translate(pattern.lstrip("/")))
+        self.patterns.append((regex, negated, directories_only, anchored))
+
+    def read(self, file_name: Path):
+        """Add the patterns of a file such as .gitignore, one per line."""
+        with open(file_name) as f:
+            for line in f:
+                self.add(line)
+
+    def excluded(self, path: str, is_dir: bool) -> bool:
+        """Whether path, relative and with slashes, is excluded."""
+        name = path.rsplit("/", 1)[-1]
+        result = False
+        for regex, negated, directories_only, anchored in self.patterns:
+            if directories_only and not is_dir:
+                continue
+            if regex.fullmatch(path if anchored else name):
+                result = not negated
+        return result
+
+
+def _translate(pattern: str) -> str:
+    r = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            r.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            r.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            r.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            r.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            chars = pattern[i + 1 : end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            r.append("[" + chars.replace("\\", "\\\\") + "]")
+            i = end + 1
+        else:
+            r.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(r)
+
+
+class FileFinder:
+    """Source files under directories, found with os.scandir while they are needed.
+
+    Excluded directories are pruned before they are entered, so are
+    virtualenvs (directories with a pyvenv.cfg) below the scanned ones and
+    symbolic links to directories. Entries are visited in name order,
+    files of a directory before its subdirectories. Paths given as files
+    are yielded as they are.
+    """
+
+    def __init__(self, excludes: ExcludePatterns = None, recursive: bool = True, suffix=".py"):
+        self.excludes = excludes or ExcludePatterns(DEFAULT_EXCLUDES)
+        self.recursive = recursive
+        self.suffix = suffix
+
+    def find(self, paths: Iterable[Path]) -> Iterator[Path]:
+        for path in paths:
+            path = Path(path)
+            if path.is_dir():
+                yield from self.walk(path)
+            else:
+                yield path
+
+    def walk(self, root: Path) -> Iterator[Path]:
+        stack = [(str(root), "")]
+        while stack:
+            directory, relative = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    entries = sorted(entries, key=lambda e: e.name)
+            except OSError as e:
+                logger.warning(f"Skipping {directory}: {e.strerror}")
+                continue
+            if relative and any(e.name == "pyvenv.cfg" for e in entries):
+                continue
+            subdirectories = []
+            for entry in entries:
+                path = relative + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if self.recursive and not self.excludes.excluded(path, True):
+                        subdirectories.append((entry.path, path + "/"))
+                elif (
+                    entry.name.endswith(self.suffix)
+                    and entry.is_file()
+                    and not self.excludes.excluded(path, False)
+                ):
+                    yield Path(entry.path)
+            stack.extend(reversed(subdirectories))
+
+
+def read_file_list(file_name: Path) -> Iterator[Path]:
+    """Paths listed one per line in file_name, read while they are needed."""
+    with open(file_name) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield Path(line)
@@ -0,0 +1,118 @@
+from __future__ import annotations
+import cProfile
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from clonedigger.settings import logger
+
+
+class Instrumentation:
+    """Timings, counters and memory peaks of the phases of a run.
+
+    Phases run one after another and are timed by `phase`. Listeners in
+    on_phase_start are called with the name of a phase and those in
+    on_phase_end with its record. With trace_memory the tracemalloc peak of
+    each phase is recorded, with profile_dir each phase is profiled with
+    cProfile into profile_dir/<phase>.prof. Everything ends up in the
+    manifest, a JSON document.
+    """
+
+    def __init__(self, trace_memory: bool = False, profile_dir: Path = None):
+        self.trace_memory = trace_memory
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.on_phase_start = []
+        self.on_phase_end = []
+        self.phases = []
+        self.counters = Counter()
+        self.histograms = {}
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self._started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        if self.profile_dir:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def phase(self, name: str):
+        for callback in self.on_phase_start:
+            callback(name)
+        record = dict(name=name, start=round(time.perf_counter() - self._t0, 4), ctime=time.ctime())
+        profile = None
+        if self.profile_dir:
+            profile = cProfile.Profile()
+            profile.enable()
+        if self.trace_memory and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()  # Python 3.9, before the peak is that of the run so far
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - t0, 4)
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record["memory_mb"] = round(current / 2**20, 2)
+                record["peak_memory_mb"] = round(peak / 2**20, 2)
+            if profile is not None:
+                profile.disable()
+                record["profile"] = str(self.profile_dir / f"{name}.prof")
+                profile.dump_stats(record["profile"])
+            self.phases.append(record)
+            logger.debug(f"{name}: {record['seconds']:.2f}s")
+            for callback in self.on_phase_end:
+                callback(record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def histogram(self, name: str, values):
+        self.histograms[name] = dict(sorted(Counter(values).items()))
+
+    def total_time(self) -> float:
+        return sum(e["seconds"] for e in self.phases)
+
+    def manifest(self, **extra) -> dict:
+        return dict(
+            started_at=time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started_at)),
+            python=sys.version.split()[0],
+            platform=platform.platform(),
+            **extra,
+            phases=self.phases,
+            total_seconds=round(self.total_time(), 4),
+            counters=dict(self.counters),
+            # keys are sizes, JSON object keys are strings
+            histograms={k: {str(size): n for size, n in v.items()} for k, v in self.histograms.items()},
+            max_rss_mb=max_rss_mb(),
+        )
+
+    def write_manifest(self, file_name: Path, **extra):
+        with open(file_name, "w") as f:
+            json.dump(self.manifest(**extra), f, indent=2, default=str)
+            f.write("\n")
+
+
+def max_rss_mb() -> int | None:
+    """Peak resident memory of the process in MB, None where it is not known."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, bytes on macOS
+    return max_rss // 2**20 if sys.platform == "darwin" else max_rss // 1024
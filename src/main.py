@@ -1,42 +1,212 @@
+import os
+from typing import Iterable
 from clonedigger.backend import ast_wrapper, clone_detection_algorithm
-from clonedigger.report import html_report
+from clonedigger.backend.parse_cache import ParseCache
+from clonedigger.instrumentation import Instrumentation
 from clonedigger.settings import Settings, logger
 from pathlib import Path
 
+# modules needed by some runs only (the process pool, out-of-core mode, shards,
+# the clone index and the report formats) are imported where they are used,
+# which keeps the start of a run on a few files short
 
-def main(fps: list[Path], output: Path, func_prefixes: list[str] = None, cfg: Settings = None):
+
+def open_parse_cache(cfg: Settings = None):
+    if cfg and cfg.cache_dir:
+        return ParseCache(cfg.cache_dir, cfg.cache_size * 2**20)
+    return None
+
+
+def parse_file(
+    file_name: Path, func_prefixes: list[str], cfg: Settings = None, cache: ParseCache = None
+) -> ast_wrapper.ASTWrapper:
+    """Parse and fingerprint a file, or load it from cache.
+
+    cache is the parse cache of cfg, opened here if it is not given; callers
+    parsing many files open it once.
+    """
+    data = file_name.read_bytes()
+    key = None
+    if cache is None:
+        cache = open_parse_cache(cfg)
+    if cache:
+        key = cache.key(data, cfg, func_prefixes)
+        source_file = cache.load(key)
+        if source_file is not None:
+            logger.info(f"Parsing {file_name}... cached")
+            # entries are shared by files with the same content
+            source_file._source_file.file_name = file_name
+            return source_file
+
+    logger.info(f"Parsing {file_name}...")
+    source_file = ast_wrapper.ASTWrapper(
+        file_name, func_prefixes, data, compact=cfg.compact_trees if cfg else False
+    )
+    if cfg:
+        source_file.fingerprint(cfg)
+    if cache:
+        cache.store(key, source_file)
+    return source_file
+
+
+def parse_files(
+    fps: Iterable[Path], func_prefixes: list[str], jobs: int = 1, cfg: Settings = None
+) -> list:
+    """Parse fps using `jobs` processes, the result keeps the order of fps.
+
+    fps may be an iterator. With one job files are parsed while it yields
+    them, with more it is read first, so that the largest files are parsed
+    first and no more workers are started than there are files.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    cache = open_parse_cache(cfg)
+    if jobs > 1:
+        fps = list(fps)
+    if jobs == 1 or len(fps) < 2:
+        source_files = [parse_file(fp, func_prefixes, cfg, cache) for fp in fps]
+    else:
+        source_files = _parse_files_parallel(fps, func_prefixes, jobs, cfg, cache)
+    if cache:
+        cache.evict()
+    return source_files
+
+
+_worker_cache = None  # the parse cache of a worker process of _parse_files_parallel
+
+
+def _init_worker(cache):
+    global _worker_cache
+    _worker_cache = cache
+
+
+def _parse_file_in_worker(fp, func_prefixes, cfg):
+    return parse_file(fp, func_prefixes, cfg, _worker_cache)
+
+
+def _parse_files_parallel(fps, func_prefixes, jobs, cfg, cache=None):
+    from concurrent.futures import ProcessPoolExecutor
+
+    # largest files first, so a big file does not end up alone on the last worker
+    jobs = min(jobs, len(fps))
+    order = sorted(enumerate(fps), key=lambda e: -e[1].stat().st_size)
+    futures = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(cache,)) as pool:
+        for i, fp in order:
+            futures[i] = fp, pool.submit(_parse_file_in_worker, fp, func_prefixes, cfg)
+        source_files = [None] * len(futures)
+        for i, (fp, future) in futures.items():
+            try:
+                source_files[i] = future.result()
+            except RecursionError:
+                # too deep to be sent back from the worker
+                source_files[i] = parse_file(fp, func_prefixes, cfg, cache)
+    return source_files
+
+
+def find_clones(
+    fps: Iterable[Path], func_prefixes: list[str], cfg: Settings, instrumentation
+) -> dict:
+    """Result of clone detection in fps, in memory or out of core.
+
+    fps may be an iterator, the names of the files found are in result["file_names"].
+    """
+    out_of_core_mode = cfg.memory_limit > 0
+    if out_of_core_mode and not (cfg.clusterize_using_dcup or cfg.clusterize_using_hash):
+        logger.warning("Out-of-core mode needs hash based marks, keeping everything in memory")
+        out_of_core_mode = False
+    if out_of_core_mode and cfg.shard_index:
+        logger.warning("Shard indexes are written by in-memory scans, keeping everything in memory")
+        out_of_core_mode = False
+    if out_of_core_mode:
+        if cfg.index or cfg.incremental:
+            logger.warning("The clone index is not used in out-of-core mode")
+        from clonedigger.backend import out_of_core
+
+        fps = list(fps)
+        result = out_of_core.main(fps, func_prefixes, cfg, instrumentation=instrumentation)
+        return dict(result, file_names=fps)
+
+    with instrumentation.phase("parse"):
+        source_files = parse_files(fps, func_prefixes, jobs=cfg.jobs, cfg=cfg)
+    fps = [e._source_file.file_name for e in source_files]
+    instrumentation.count("files", len(fps))
+
+    index = None
+    if cfg.shard_index or cfg.index or cfg.incremental:
+        from clonedigger.backend.clone_index import CloneIndex
+    if cfg.shard_index:
+        index = CloneIndex(cfg.shard_index, func_prefixes=func_prefixes)
+    elif cfg.index or cfg.incremental:
+        index = CloneIndex(cfg.index or ".clonedigger.db", func_prefixes=func_prefixes)
+    try:
+        result = clone_detection_algorithm.main(
+            source_files, cfg, index=index, instrumentation=instrumentation
+        )
+        return dict(result, file_names=fps)
+    finally:
+        if index is not None:
+            index.close()
+
+
+def report_class(output_format: str) -> type:
+    if output_format == "jsonl":
+        from clonedigger.report.jsonl_report import JSONLinesReport
+
+        return JSONLinesReport
+    if output_format == "sarif":
+        from clonedigger.report.sarif_report import SARIFReport
+
+        return SARIFReport
+    from clonedigger.report.html_report import HTMLReport
+
+    return HTMLReport
+
+
+def main(
+    fps: Iterable[Path],
+    output: Path,
+    func_prefixes: list[str] = None,
+    cfg: Settings = None,
+    instrumentation: Instrumentation = None,
+):
     cfg = cfg or Settings()
+    if instrumentation is None:
+        instrumentation = Instrumentation(trace_memory=cfg.trace_memory, profile_dir=cfg.profile_dir)
+        with instrumentation:
+            return main(fps, output, func_prefixes, cfg, instrumentation)
     logger.setLevel(cfg.logger_level)
-    wrapper = ast_wrapper.ASTWrapper
-    fps = [e for e in fps if e.suffix == f".{wrapper.extension}"]
-    report = html_report.HTMLReport()
-    source_files = []
+    report = report_class(cfg.output_format)()
     func_prefixes = func_prefixes or []
 
-    def parse_file(file_name, func_prefixes):
-        logger.info(f"Parsing {file_name}...")
-        source_file = wrapper(file_name, func_prefixes)
-        source_file._tree.propagateCoveredLineNumbers()
-        source_file._tree.propagateHeight()
-        source_files.append(source_file)
-        report.file_names += [file_name]
-
-    report.startTimer("Construction of AST")
-    for file_name in fps:
-        parse_file(file_name, func_prefixes)
-    report.stopTimer()
+    if cfg.merge:
+        from clonedigger.backend import shards
 
-    result = clone_detection_algorithm.main(source_files, cfg)
+        # fps are shard indexes, the report is about the files they record
+        result = shards.merge(list(fps), func_prefixes, cfg, instrumentation=instrumentation)
+    else:
+        wrapper = ast_wrapper.ASTWrapper
+        fps = (e for e in fps if e.suffix == f".{wrapper.extension}")
+        result = find_clones(fps, func_prefixes, cfg, instrumentation)
+    report.file_names += result["file_names"]
     report.clones = result["clones"]
     report.all_source_lines_count = result["all_source_lines_count"]
     report.covered_source_lines_count = result["covered_source_lines_count"]
     report.mark_to_statement_hash = result["mark_to_statement_hash"]
 
-    report.sort()
-    try:
-        report.writeReport(output, cfg)
-    except Exception:
-        logger.error("caught error, removing output file")
-        if output.exists():
-            output.unlink()
-        raise
+    report.timers = [[e["name"], e["seconds"], e["ctime"]] for e in instrumentation.phases]
+
+    if cfg.shard_index:
+        logger.info(f"Shard index written to {cfg.shard_index}, merge shards with --merge")
+    else:
+        try:
+            with instrumentation.phase("report"):
+                report.sort()
+                report.writeReport(output, cfg)
+        except Exception:
+            logger.error("caught error, removing output file")
+            Path(output).unlink(missing_ok=True)  # it may have been partly written
+            raise
+        finally:
+            ast_wrapper.SourceFile.close_all()
+    if cfg.manifest:
+        instrumentation.write_manifest(cfg.manifest, output=str(output), settings=cfg.model_dump())
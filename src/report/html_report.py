@@ -1,8 +1,27 @@
+import functools
+import gzip
 import time
 from pathlib import Path
-from jinja2 import Template
+from typing import TYPE_CHECKING
 
-from clonedigger.backend.clone_detection_algorithm import Unifier
+if TYPE_CHECKING:
+    import jinja2
+
+
+@functools.lru_cache(maxsize=None)
+def get_template() -> "jinja2.Template":
+    # compiled once, later reports of this process reuse it; JSON Lines and SARIF
+    # reports share this module and never import jinja2
+    from jinja2 import Environment, FileSystemLoader
+
+    env = Environment(loader=FileSystemLoader(Path(__file__).parent))
+    return env.get_template("template.html")
+
+
+def open_output(file_name: Path):
+    if str(file_name).endswith(".gz"):
+        return gzip.open(file_name, "wt")
+    return open(file_name, "w")
 
 
 class Report:
@@ -17,35 +36,43 @@ class Report:
         # sortByCloneSize
         self.clones.sort(key=lambda x: -x.getMaxCoveredLineNumbersCount())
 
+    @staticmethod
+    def getLineRange(sequence) -> tuple[int, int]:
+        """First and last line of a sequence, counted from 1."""
+        line_numbers = sequence.getCoveredLineNumbers()
+        return min(line_numbers) + 1, max(line_numbers) + 1
+
     def startTimer(self, descr: str):
         self.timers.append([descr, time.time(), time.ctime()])
 
     def stopTimer(self, descr: str = ""):
         self.timers[-1][1] = time.time() - self.timers[-1][1]
 
+    def getTotalTime(self) -> float:
+        return sum(e[1] for e in self.timers)
+
 
 class HTMLReport(Report):
-    def writeReport(self, file_name: Path, cfg):
-        table = []
+    def iterClones(self, cfg):
+        """Template data of the clones, built one clone at a time.
+
+        Distances and differing rows were stored by the clone detection.
+        """
         for idx, clone in enumerate(self.clones):
-            rows = []
-            for i in range(len(clone[0])):
-                statements = [clone[j][i] for j in [0, 1]]
-                u = Unifier(*statements, cfg=cfg)
-                rows += [[u.getSize() > 0, *[e.as_string() for e in statements]]]
-            table += [
-                dict(
-                    idx=idx,
-                    distance=clone.calcDistance(),
-                    cloned_length=max(
-                        len(set(e.getCoveredLineNumbers())) for e in clone
-                    ),
-                    filenames=[e.source_file.file_name for e in clone],
-                    linenos=[min(e[0].getCoveredLineNumbers()) + 1 for e in clone],
-                    rows=rows,
-                )
+            rows = [
+                [differs, *[e.as_string() for e in statements]]
+                for differs, *statements in zip(clone.row_differences, clone[0], clone[1])
             ]
+            yield dict(
+                idx=idx,
+                distance=clone.distance,
+                cloned_length=max(len(set(e.getCoveredLineNumbers())) for e in clone),
+                filenames=[e.source_file.file_name for e in clone],
+                linenos=[min(e[0].getCoveredLineNumbers()) + 1 for e in clone],
+                rows=rows,
+            )
 
+    def writeReport(self, file_name: Path, cfg):
         lines_dup = self.covered_source_lines_count
         lines_ttl = self.all_source_lines_count
         lines_perc = round(lines_dup * 100.0 / lines_ttl, 2) or 100
@@ -60,7 +87,7 @@ class HTMLReport(Report):
             errors_info=self.error_info,
             timings="",
             marks_report="",
-            table=table,
+            table=self.iterClones(cfg),
         )
 
         if cfg.print_time:
@@ -74,29 +101,27 @@ class HTMLReport(Report):
             timings += "<BR>\n Finished at: " + self.timers[-1][2]
             result["timings"] = timings
         if self.mark_to_statement_hash:
-            marks_report = "<P>Top 20 statement marks:"
+            marks_report = ["<P>Top 20 statement marks:"]
             marks = list(self.mark_to_statement_hash)
             marks.sort(key=lambda x: -len(self.mark_to_statement_hash[x]))
             counter = 0
             for mark in marks[:20]:
                 counter += 1
-                marks_report += (
-                    "<BR>"
-                    + str(len(self.mark_to_statement_hash[mark]))
-                    + ":"
-                    + str(mark.pattern)
-                    + "<a href=\"javascript:unhide('stmt%d');\">show/hide representatives</a> "
-                    % counter
-                )
-                marks_report += '<div id="stmt%d" class="hidden"> <BR>' % counter
+                marks_report += [
+                    "<BR>",
+                    str(len(self.mark_to_statement_hash[mark])),
+                    ":",
+                    str(mark.pattern),
+                    "<a href=\"javascript:unhide('stmt%d');\">show/hide representatives</a> "
+                    % counter,
+                    '<div id="stmt%d" class="hidden"> <BR>' % counter,
+                ]
                 for statement in self.mark_to_statement_hash[mark]:
-                    marks_report += str(statement) + "<BR>"
-                marks_report += "</div>"
-                marks_report += "</P>"
-            result["marks_report"] = marks_report
-
-        with open(Path(__file__).parent / "template.html") as f:
-            template = Template(f.read())
-        html = template.render(**result)
-        with open(file_name, "w") as f:
-            f.write(html)
+                    marks_report += [str(statement), "<BR>"]
+                marks_report += ["</div>", "</P>"]
+            result["marks_report"] = "".join(marks_report)
+
+        template = get_template()
+        with open_output(file_name) as f:
+            for chunk in template.generate(**result):
+                f.write(chunk)
@@ -0,0 +1,36 @@
+import json
+from pathlib import Path
+from clonedigger.report.html_report import Report, open_output
+
+
+class JSONLinesReport(Report):
+    """One JSON object per clone and line, written as the clones are visited.
+
+    Records are written once detection has finished, not as each clone is
+    found: a clone is only final once the clones dominating it are known,
+    and clones are numbered largest first as in the HTML report. Records are
+    serialized one at a time, without the HTML rows or the template, and
+    readers can take them one line at a time.
+    """
+
+    def iterRecords(self):
+        for idx, clone in enumerate(self.clones):
+            fragments = []
+            for sequence in clone:
+                first, last = self.getLineRange(sequence)
+                fragments.append(
+                    dict(file=str(sequence.source_file.file_name), first_line=first, last_line=last)
+                )
+            yield dict(
+                clone=idx,
+                distance=clone.distance,
+                size=clone.getMaxCoveredLineNumbersCount(),
+                statements=len(clone),
+                fragments=fragments,
+            )
+
+    def writeReport(self, file_name: Path, cfg):
+        with open_output(file_name) as f:
+            for record in self.iterRecords():
+                f.write(json.dumps(record))
+                f.write("\n")
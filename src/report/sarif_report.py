@@ -0,0 +1,81 @@
+import json
+from pathlib import Path
+from clonedigger.report.html_report import open_output
+from clonedigger.report.jsonl_report import JSONLinesReport
+
+RULE_ID = "duplicate-code"
+
+
+class SARIFReport(JSONLinesReport):
+    """A SARIF 2.1.0 log with one result per clone.
+
+    The envelope is written around the results, which are serialized one at
+    a time, so the log is never held in memory.
+    """
+
+    def getEnvelope(self, cfg) -> dict:
+        driver = dict(
+            name="clonedigger",
+            informationUri="http://clonedigger.sourceforge.net",
+            rules=[
+                dict(
+                    id=RULE_ID,
+                    shortDescription=dict(text="Duplicate code"),
+                    properties=dict(
+                        size_threshold=cfg.size_threshold,
+                        distance_threshold=cfg.distance_threshold,
+                    ),
+                )
+            ],
+        )
+        return {
+            "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+            "version": "2.1.0",
+            "runs": [dict(tool=dict(driver=driver), results=[])],
+        }
+
+    @staticmethod
+    def getLocation(fragment: dict, id: int = None) -> dict:
+        path = Path(fragment["file"])
+        location = dict(
+            physicalLocation=dict(
+                artifactLocation=dict(uri=path.as_uri() if path.is_absolute() else path.as_posix()),
+                region=dict(startLine=fragment["first_line"], endLine=fragment["last_line"]),
+            )
+        )
+        if id is not None:
+            location["id"] = id
+        return location
+
+    def iterResults(self):
+        for record in self.iterRecords():
+            this, other = record["fragments"]
+            yield dict(
+                ruleId=RULE_ID,
+                level="warning",
+                message=dict(
+                    text=f"{record['size']} lines are similar to {other['file']} "
+                    f"at line {other['first_line']} (distance {record['distance']})"
+                ),
+                locations=[self.getLocation(this)],
+                relatedLocations=[self.getLocation(other, 0)],
+                properties=dict(
+                    clone=record["clone"],
+                    distance=record["distance"],
+                    size=record["size"],
+                    statements=record["statements"],
+                ),
+            )
+
+    def writeReport(self, file_name: Path, cfg):
+        # the results are spliced into the empty list of the envelope
+        head, tail = json.dumps(self.getEnvelope(cfg)).rsplit('"results": []', 1)
+        with open_output(file_name) as f:
+            f.write(head)
+            f.write('"results": [')
+            for i, result in enumerate(self.iterResults()):
+                if i:
+                    f.write(", ")
+                f.write(json.dumps(result))
+            f.write("]")
+            f.write(tail)
@@ -0,0 +1,387 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterable
+from clonedigger.backend import clone_detection_algorithm as cda
+from clonedigger.backend.ast_wrapper import (
+    ASTWrapper,
+    canonical_id_count,
+    canonical_id_generation,
+    clear_canonical_ids,
+)
+from clonedigger.backend.line_coverage import LineCoverage
+from clonedigger.client import DEFAULT_SOCKET, request
+from clonedigger.discovery import FileFinder
+from clonedigger.main import open_parse_cache, parse_file, parse_files
+from clonedigger.report.jsonl_report import JSONLinesReport
+from clonedigger.settings import Settings, logger
+
+
+class CloneServer:
+    """Clones of a set of files, kept in memory and updated as files change.
+
+    Files are parsed once; their statement sequences, the hash buckets of
+    their statements and the clones are kept. When files change, only the
+    clusters (marks) of the buckets they touch are built again, and the
+    suffix array is built from the sequences sharing a mark with a changed
+    file, as an incremental scan does. Clones between unchanged files are
+    kept as they are, and so is the unification cache. File names are
+    absolute, queries read the clones of a file from a map.
+
+    Canonical ids of earlier versions of files stay in the id table, so it
+    is interned again from the live trees once it has doubled, or once a
+    run in the same process has cleared it.
+    """
+
+    min_canonical_ids = 2**16  # the id table is not compacted below this size
+
+    def __init__(self, func_prefixes: list[str], cfg: Settings, finder: FileFinder = None):
+        self.func_prefixes = func_prefixes
+        self.cfg = cfg
+        self.finder = finder or FileFinder(recursive=not cfg.no_recursion)
+        self.stopped = False
+        self.files = {}  # file name -> ASTWrapper
+        self.sequences = {}  # file name -> sequences searched for clones
+        self.hashes = {}  # file name -> hashes of its statements
+        self.line_counts = {}  # file name -> source lines covered by its sequences
+        self.covered_counts = {}  # file name -> source lines covered by its clones
+        self.buckets = {}  # hash -> statements with the hash, all marked with one cluster
+        self.clones = []
+        self.clones_of = {}  # file name -> clones with a fragment in the file
+        cda.unification_cache.clear(cfg.unification_cache_size)
+        clear_canonical_ids()
+        self.canonical_id_generation = canonical_id_generation()
+        self.compact_canonical_ids_at = self.min_canonical_ids
+
+    def load(self, fps: Iterable[Path]) -> dict:
+        """Parse and analyse the files the server starts with."""
+        extension = f".{ASTWrapper.extension}"
+        fps = (Path(os.path.abspath(e)) for e in fps if str(e).endswith(extension))
+        source_files = parse_files(fps, self.func_prefixes, jobs=self.cfg.jobs, cfg=self.cfg)
+        return self._apply(source_files, set())
+
+    def update(self, paths: Iterable[str]) -> dict:
+        """Parse again the files of paths that changed and forget those that are gone.
+
+        Directories are scanned again with the excludes the server started
+        with. A file that does not parse any more is forgotten until it does.
+        """
+        found = set()
+        gone = set()
+        for path in map(os.path.abspath, paths):
+            if os.path.isdir(path):
+                found.update(str(e) for e in self.finder.find([Path(path)]))
+                gone.update(self._files_under(path))
+            elif os.path.isfile(path):
+                found.add(path)
+            else:
+                gone.update(self._files_under(path))
+        source_files = []
+        errors = {}
+        cache = open_parse_cache(self.cfg)
+        for name in sorted(found):
+            if not name.endswith(f".{ASTWrapper.extension}"):
+                continue
+            try:
+                data = Path(name).read_bytes()
+                known = self.files.get(name)
+                if known is not None and known.digest == hashlib.sha256(data).hexdigest():
+                    gone.discard(name)
+                    continue
+                source_files.append(parse_file(Path(name), self.func_prefixes, self.cfg, cache))
+                gone.discard(name)
+            except (OSError, SyntaxError, ValueError) as e:
+                errors[name] = f"{type(e).__name__}: {e}"
+                gone.add(name)
+        result = self._apply(source_files, gone & self.files.keys())
+        return dict(result, errors=errors)
+
+    def _hash(self, statement) -> int:
+        if self.cfg.clusterize_using_hash:
+            return statement.getFullHash()
+        return statement.getDCupHash(self.cfg.hashing_depth)
+
+    def _add(self, source_file: ASTWrapper) -> set:
+        name = str(source_file._source_file.file_name)
+        self.files[name] = source_file
+        sequences = source_file.statement_sequences
+        cda.calc_statement_sizes(sequences, self.cfg)
+        cda.assign_canonical_ids(sequences)
+        hashes = self.hashes[name] = []
+        for sequence in sequences:
+            for statement in sequence:
+                h = self._hash(statement)
+                self.buckets.setdefault(h, []).append(statement)
+                hashes.append(h)
+        return set(hashes)
+
+    def _remove(self, name: str) -> set:
+        source_file = self.files.pop(name)._source_file
+        del self.sequences[name], self.line_counts[name], self.covered_counts[name]
+        hashes = set(self.hashes.pop(name))
+        for h in hashes:
+            self.buckets[h] = [e for e in self.buckets[h] if e.source_file is not source_file]
+        return hashes
+
+    def _apply(self, source_files: list[ASTWrapper], removed: set[str]) -> dict:
+        cfg = self.cfg
+        if canonical_id_generation() != self.canonical_id_generation:
+            self.compact_canonical_ids()
+        added = [str(e._source_file.file_name) for e in source_files]
+        changed = set(added) | removed
+        touched = set()
+        for name in changed & self.files.keys():
+            touched |= self._remove(name)
+        added_hashes = set()
+        for source_file in source_files:
+            added_hashes |= self._add(source_file)
+        for h in touched | added_hashes:
+            bucket = self.buckets.get(h)
+            if not bucket:
+                self.buckets.pop(h, None)
+                continue
+            cluster = cda.Cluster(cfg=cfg)
+            for statement in bucket:
+                cluster.addWithoutUnification(statement)
+                statement.mark = cluster
+
+        for name in added:
+            sequences = self.files[name].statement_sequences
+            if not cfg.force:
+                sequences = cda.filter_long_sequences(sequences)
+            self.sequences[name] = sequences
+            source_lines = LineCoverage()
+            for sequence in sequences:
+                source_lines.add(sequence)
+            self.line_counts[name] = len(source_lines)
+
+        # only files with a statement in the buckets of the added ones can share a clone with them
+        related = {str(s.source_file.file_name) for h in added_hashes for s in self.buckets[h]}
+        search_sequences = cda.select_changed(
+            [s for name in sorted(related) for s in self.sequences[name]], set(added)
+        )
+        candidates = (
+            e for e in cda.find_sequences(search_sequences, cfg) if _file_names(e) & changed
+        )
+        if cfg.distance_threshold != -1:
+            clones = cda.remove_dominated_clones(cda.refine_duplicate_candidates(candidates, cfg))
+        else:
+            clones = list(candidates)
+        for clone in clones:
+            clone.storeDistances()
+
+        kept = []
+        affected = set(added)  # files whose clones changed
+        for clone in self.clones:
+            names = _file_names(clone)
+            if names & changed:
+                affected |= names
+            else:
+                kept.append(clone)
+        for clone in clones:
+            affected |= _file_names(clone)
+        self.clones = kept + clones
+        if canonical_id_count() > self.compact_canonical_ids_at:
+            self.compact_canonical_ids()
+        self.clones_of = {}
+        for clone in self.clones:
+            for name in _file_names(clone):
+                self.clones_of.setdefault(name, []).append(clone)
+        for name in affected & self.files.keys():
+            covered_lines = LineCoverage()
+            for clone in self.clones_of.get(name, []):
+                for sequence in clone:
+                    if str(sequence.source_file.file_name) == name:
+                        covered_lines.add(sequence)
+            self.covered_counts[name] = len(covered_lines)
+        return dict(
+            parsed=sorted(added),
+            removed=sorted(removed - set(added)),
+            new_clones=len(clones),
+            clones=len(self.clones),
+        )
+
+    def compact_canonical_ids(self):
+        """Intern the canonical ids of the live trees only, in a new table."""
+        cda.unification_cache.clear()
+        cda.reset_canonical_ids(self.files.values())
+        self.canonical_id_generation = canonical_id_generation()
+        for source_file in self.files.values():
+            cda.assign_canonical_ids(source_file.statement_sequences)
+        self.compact_canonical_ids_at = max(2 * canonical_id_count(), self.min_canonical_ids)
+
+    def _files_under(self, path: str) -> list[str]:
+        if path in self.files:
+            return [path]
+        prefix = path.rstrip(os.sep) + os.sep
+        return [e for e in self.files if e.startswith(prefix)]
+
+    def clones_involving(self, paths: Iterable[str]) -> list[dict]:
+        """Records of the clones with a fragment in one of paths, files or directories.
+
+        Records are those of --format jsonl, largest clones first.
+        """
+        clones = {}
+        for path in map(os.path.abspath, paths):
+            for name in self._files_under(path):
+                for clone in self.clones_of.get(name, []):
+                    clones[id(clone)] = clone
+        report = JSONLinesReport()
+        report.clones = list(clones.values())
+        report.sort()
+        return list(report.iterRecords())
+
+    def stats(self, path: str) -> dict:
+        """Duplication of the files under path, a file or a directory."""
+        names = sorted(self._files_under(os.path.abspath(path)))
+        clones = {id(clone) for name in names for clone in self.clones_of.get(name, [])}
+        total = sum(self.line_counts[e] for e in names)
+        covered = sum(self.covered_counts[e] for e in names)
+        return dict(
+            files=len(names),
+            clones=len(clones),
+            source_lines=total,
+            covered_lines=covered,
+            coverage=100 * covered / total if total else 0.0,
+            file_coverage={
+                e: 100 * self.covered_counts[e] / self.line_counts[e]
+                for e in names
+                if self.line_counts[e]
+            },
+        )
+
+    def status(self) -> dict:
+        return dict(
+            files=len(self.files),
+            statements=sum(map(len, self.hashes.values())),
+            hash_buckets=len(self.buckets),
+            clones=len(self.clones),
+            unification_cache_hits=cda.unification_cache.hits,
+            unifications=cda.unification_cache.misses,
+        )
+
+    def handle(self, message: dict) -> dict:
+        """The response to a message of the protocol, see serve."""
+        op = message.get("op")
+        paths = message.get("paths") or []
+        if op == "clones":
+            return dict(clones=self.clones_involving(paths))
+        if op == "stats":
+            # file names are absolute, so everything is under the root
+            return dict(stats={path: self.stats(path) for path in paths or [os.sep]})
+        if op == "update":
+            return self.update(paths)
+        if op == "status":
+            return self.status()
+        if op == "shutdown":
+            self.stopped = True
+            return dict(stopped=True)
+        raise ValueError(f"unknown op {op!r}")
+
+
+def _file_names(clone) -> set[str]:
+    return {str(sequence.source_file.file_name) for sequence in clone}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        self.timeout = self.server.client_timeout  # set on the connection by setup
+        super().setup()
+
+    def handle(self):
+        clone_server = self.server.clone_server
+        try:
+            for line in self.rfile:
+                t0 = time.perf_counter()
+                with self.server.lock:
+                    try:
+                        response = clone_server.handle(json.loads(line))
+                    except Exception as e:
+                        logger.warning(f"Request failed: {type(e).__name__}: {e}")
+                        response = dict(error=f"{type(e).__name__}: {e}")
+                response["seconds"] = round(time.perf_counter() - t0, 4)
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+                if clone_server.stopped:
+                    break
+        except (socket.timeout, ConnectionError):
+            pass  # an idle or vanished client, its connection is closed
+
+
+def serve(clone_server: CloneServer, socket_path: Path = DEFAULT_SOCKET, timeout: float = 60):
+    """Answer messages on a Unix socket until a shutdown message comes.
+
+    The protocol is JSON Lines: a client sends objects with an "op" and
+    "paths", absolute or relative to the working directory of the server,
+    and gets one object back for each, with "error" if the message failed
+    and the "seconds" it took. Ops are "clones" (the clones involving
+    paths), "stats" (duplication under each of paths, everything by
+    default), "update" (paths changed, were added or removed), "status" and
+    "shutdown". Each connection is served in its own thread and may send
+    several messages, which are answered one at a time. A connection that
+    sends nothing for timeout seconds is closed.
+    """
+    socket_path = Path(socket_path)
+    _check_socket(socket_path)
+    with socketserver.ThreadingUnixStreamServer(str(socket_path), _RequestHandler) as server:
+        server.daemon_threads = True  # connections left open do not delay the shutdown
+        server.timeout = 0.5  # how often the loop looks for a shutdown
+        server.client_timeout = timeout
+        server.lock = threading.Lock()
+        server.clone_server = clone_server
+        logger.info(f"Serving {len(clone_server.files)} files on {socket_path}")
+        try:
+            while not clone_server.stopped:
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def _check_socket(socket_path: Path):
+    if not socket_path.exists():
+        return
+    try:
+        request(socket_path, dict(op="status"), timeout=1)
+    except (ConnectionRefusedError, FileNotFoundError):
+        socket_path.unlink(missing_ok=True)  # left by a server that did not stop
+        return
+    except OSError:
+        pass  # a server busy with a long update does not answer in time
+    logger.error(f"A server is already listening on {socket_path}")
+    sys.exit(1)
+
+
+def main(
+    fps: Iterable[Path],
+    func_prefixes: list[str] = None,
+    cfg: Settings = None,
+    socket_path: Path = DEFAULT_SOCKET,
+    finder: FileFinder = None,
+):
+    cfg = cfg or Settings()
+    logger.setLevel(cfg.logger_level)
+    if not (cfg.clusterize_using_dcup or cfg.clusterize_using_hash):
+        logger.error("The server needs hash based marks")
+        sys.exit(1)
+    if cfg.memory_limit or cfg.index or cfg.incremental or cfg.shard_index or cfg.merge:
+        logger.warning(
+            "The server keeps everything in memory, --memory-limit, --index, --incremental, "
+            "--shard-index and --merge are not used"
+        )
+    _check_socket(Path(socket_path))
+    clone_server = CloneServer(func_prefixes or [], cfg, finder)
+    t0 = time.perf_counter()
+    result = clone_server.load(fps)
+    logger.info(
+        f"{len(result['parsed'])} files, {result['clones']} clones "
+        f"in {time.perf_counter() - t0:.2f}s"
+    )
+    serve(clone_server, socket_path)
@@ -1,10 +1,14 @@
+import dataclasses
 import logging
 import sys
-from pydantic import BaseModel
+from typing import Literal, Optional
 
+OUTPUT_FORMATS = ("html", "jsonl", "sarif")
 
-class Settings(BaseModel):
-    model_config = {"frozen": True}
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    # a dataclass, pydantic takes longer to import than checking a few files
     # todo: describe settings
     clustering_threshold: int = 30  # looks doesnt work
     hashing_depth: int = 1
@@ -14,12 +18,38 @@ class Settings(BaseModel):
     print_time: bool = False  # report time
     force: bool = False  # check very long sequences
     no_recursion: bool = False
+    jobs: int = 1  # parsing processes, 0 - one per cpu core
+    compact_trees: bool = False  # keep parsed files in flat arrays
+    cache_dir: Optional[str] = None  # parse cache, disabled by default
+    cache_size: int = 1024  # parse cache limit, MB
+    index: Optional[str] = None  # clone index file, rewritten after every run
+    incremental: bool = False  # analyse only files changed since the index was written
+    shard_index: Optional[str] = None  # write the clone index of a shard instead of a report
+    merge: bool = False  # the inputs are shard indexes, clones across shards are added
+    unification_cache_size: int = 65536  # unification results kept, 0 disables the cache
+    cluster_index: int = 0  # hash buckets from this size look up clusters by MinHash, 0 - never
+    output_format: Literal["html", "jsonl", "sarif"] = "html"
+    manifest: Optional[str] = None  # JSON file with timings and counters of the run
+    trace_memory: bool = False  # peak memory of each phase in the manifest, slows the run
+    profile_dir: Optional[str] = None  # cProfile output of each phase
+    memory_limit: int = 0  # MB, above 0 parsed trees are dropped and data is spilled to disk
     logger_level: int = logging.DEBUG
     free_variable_cost: float = 0.5
     free_variables_count: int = 1
     size_threshold: int = 5
     distance_threshold: int = 5
 
+    def __post_init__(self):
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"output_format must be one of {', '.join(OUTPUT_FORMATS)}")
+
+    def model_dump(self) -> dict:
+        return dataclasses.asdict(self)
+
+    def __iter__(self):
+        # (name, value) pairs, as iterating a pydantic model gives
+        return iter(self.model_dump().items())
+
 
 logger = logging.getLogger()
 handler = logging.StreamHandler(sys.stdout)
@@ -0,0 +1,2 @@
+# sample inputs of the tests, not tests themselves
+collect_ignore = ["test_me.py", "test_issue6.py"]
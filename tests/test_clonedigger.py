@@ -1,6 +1,43 @@
+import ast
+import gzip
+import json
+import math
+import random
 import re
+import socket
+import subprocess
+import sys
+import threading
+import time
 from pathlib import Path
-from clonedigger.main import main
+from clonedigger.backend import clone_detection_algorithm
+from clonedigger.backend.ast_wrapper import (
+    ASTWrapper,
+    FreeVariable,
+    SourceFile,
+    StatementSequence,
+    canonical_id_count,
+)
+from clonedigger.backend.clone_index import CloneIndex
+from clonedigger.backend.cluster_index import ClusterIndex
+from clonedigger.backend.compact_tree import CompactTree
+from clonedigger.backend.line_coverage import LineCoverage
+from clonedigger.backend.out_of_core import LineStore, SortedRuns, structure_digests
+from clonedigger.backend.parse_cache import ParseCache
+from clonedigger.backend.clone_detection_algorithm import (
+    Cluster,
+    PairSequences,
+    RefineTable,
+    Unifier,
+    unification_cache,
+)
+from clonedigger.backend.suffix_array import SuffixArray
+from clonedigger.client import request
+from clonedigger.discovery import DEFAULT_EXCLUDES, ExcludePatterns, FileFinder, read_file_list
+from clonedigger.instrumentation import Instrumentation
+from clonedigger.main import find_clones, main, parse_files
+from clonedigger.server import CloneServer, serve
+from clonedigger.settings import Settings
 
 
 def test_finds_clones():
@@ -27,3 +64,558 @@ def test_multiline_strings_preserved(tmp_path):
     main(fps=[Path("tests/test_issue6.py")], output=output)
     html = output.read_text()
     assert "param (str): param" in html
+
+
+def test_source_lines(tmp_path, monkeypatch):
+    a, b = tmp_path / "a.py", tmp_path / "b.py"
+    a.write_text("x = 1\ny = 2\n")
+    b.write_text("z = 3\n")
+    monkeypatch.setattr(SourceFile, "max_open", 1)
+    source_a, source_b = SourceFile(a), SourceFile(b)
+    assert source_a.getLines([1, 0]) == ["y = 2", "x = 1"]
+    assert list(SourceFile._maps) == [source_a]  # one map per file, kept
+    assert source_b.getLines([0]) == ["z = 3"]
+    assert list(SourceFile._maps) == [source_b]
+    a.write_text("x = 1\ny = 3\n")  # same size, other content
+    assert source_a.getLines([1]) == [""]
+    SourceFile.close_all()
+    assert not SourceFile._maps
+
+
+def test_gzip_report(tmp_path):
+    fps = [Path("tests/test_me.py")]
+    main(fps=fps, output=tmp_path / "output.html")
+    main(fps=fps, output=tmp_path / "output.html.gz")
+    plain = (tmp_path / "output.html").read_text()
+    with gzip.open(tmp_path / "output.html.gz", "rt") as f:
+        compressed = f.read()
+    assert plain.split("Clone #", 1)[1] == compressed.split("Clone #", 1)[1]
+
+
+def test_machine_readable_reports(tmp_path):
+    fps = [Path("tests/test_me.py")]
+    main(fps=fps, output=tmp_path / "output.html")
+    count = int(re.search(r"Clones detected: (\d+)", (tmp_path / "output.html").read_text())[1])
+    main(fps=fps, output=tmp_path / "output.jsonl", cfg=Settings(output_format="jsonl"))
+    records = [json.loads(e) for e in (tmp_path / "output.jsonl").read_text().splitlines()]
+    assert len(records) == count
+    for record in records:
+        assert record["size"] >= 5
+        for fragment in record["fragments"]:
+            assert fragment["file"] == "tests/test_me.py"
+            assert fragment["first_line"] <= fragment["last_line"]
+    main(fps=fps, output=tmp_path / "output.sarif", cfg=Settings(output_format="sarif"))
+    sarif = json.loads((tmp_path / "output.sarif").read_text())
+    results = sarif["runs"][0]["results"]
+    assert [e["properties"]["size"] for e in results] == [e["size"] for e in records]
+    region = results[0]["locations"][0]["physicalLocation"]["region"]
+    assert region["startLine"] == records[0]["fragments"][0]["first_line"]
+
+
+def test_manifest(tmp_path):
+    events = []
+    instrumentation = Instrumentation(trace_memory=True)
+    instrumentation.on_phase_start.append(lambda name: events.append(("start", name)))
+    instrumentation.on_phase_end.append(lambda record: events.append(("end", record["name"])))
+    cfg = Settings(manifest=str(tmp_path / "manifest.json"))
+    with instrumentation:
+        main([Path("tests/test_me.py")], tmp_path / "output.html", cfg=cfg, instrumentation=instrumentation)
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    names = [e["name"] for e in manifest["phases"]]
+    assert names[0] == "parse" and names[-1] == "report"
+    assert events == [(kind, name) for name in names for kind in ("start", "end")]
+    assert all(e["peak_memory_mb"] >= 0 for e in manifest["phases"])
+    assert manifest["counters"]["files"] == 1
+    assert manifest["counters"]["clones"] > 0
+    assert sum(manifest["histograms"]["hash_bucket_sizes"].values()) == manifest["counters"]["hash_buckets"]
+
+
+def test_parallel_parsing_is_deterministic(tmp_path):
+    fps = [Path("tests/test_me.py"), Path("tests/test_issue6.py")]
+    reports = []
+    for jobs in (1, 2):
+        output = tmp_path / f"output_{jobs}.html"
+        main(fps=fps, output=output, cfg=Settings(jobs=jobs))
+        reports.append(output.read_text().split("Clone #", 1)[1])
+    assert reports[0] == reports[1]
+
+
+def test_parallel_parsing_schedule(tmp_path, monkeypatch):
+    import concurrent.futures
+
+    class Future:
+        def __init__(self, value):
+            self.value = value
+
+        def result(self):
+            return self.value
+
+    pools = []
+
+    class Pool:
+        # runs in this process and records what the real pool would be given
+        def __init__(self, max_workers, initializer=None, initargs=()):
+            self.max_workers = max_workers
+            self.submitted = []
+            pools.append(self)
+            if initializer:
+                initializer(*initargs)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def submit(self, f, fp, *args):
+            self.submitted.append(fp.name)
+            return Future(f(fp, *args))
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", Pool)
+    small, large = tmp_path / "small.py", tmp_path / "large.py"
+    small.write_text(Path("tests/test_issue6.py").read_text())
+    large.write_text(Path("tests/test_me.py").read_text() * 2)
+    # discovery yields paths lazily, as on the command line
+    main(fps=iter([small, large]), output=tmp_path / "output.html", cfg=Settings(jobs=4))
+    assert [(e.max_workers, e.submitted) for e in pools] == [(2, ["large.py", "small.py"])]
+    pools.clear()
+    main(fps=iter([large]), output=tmp_path / "output.html", cfg=Settings(jobs=0))
+    assert not pools
+
+
+def test_parse_cache(tmp_path, monkeypatch):
+    # parsed in this process, so the warm run can check that nothing is parsed
+    cfg = Settings(cache_dir=str(tmp_path / "cache"), jobs=1)
+    fps = [Path("tests/test_me.py"), Path("tests/test_issue6.py")]
+
+    def report():
+        output = tmp_path / "output.html"
+        main(fps=fps, output=output, cfg=cfg)
+        return output.read_text()
+
+    def not_cached(*args, **kwargs):
+        raise AssertionError("a cached file was parsed again")
+
+    opened = []
+    init = ParseCache.__init__
+    monkeypatch.setattr(ParseCache, "__init__", lambda self, *args: opened.append(init(self, *args)))
+    cold = report()
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+    assert len(opened) == 1  # once for all files
+    monkeypatch.setattr(ASTWrapper, "__init__", not_cached)
+    assert report() == cold
+
+
+def clone_blocks(html):
+    return sorted(re.sub(r"^ \d+", "", e) for e in html.split("Clone #")[1:])
+
+
+def test_incremental_index(tmp_path):
+    a, b = tmp_path / "a.py", tmp_path / "b.py"
+    a.write_text(Path("tests/test_me.py").read_text())
+    b.write_text(Path("tests/test_issue6.py").read_text())
+    cfg = Settings(index=str(tmp_path / "index.db"), incremental=True)
+    output = tmp_path / "output.html"
+    main(fps=[a, b], output=output, cfg=cfg)
+    full = clone_blocks(output.read_text())
+    assert full
+    # nothing changed: every clone comes from the index
+    main(fps=[a, b], output=output, cfg=cfg)
+    assert clone_blocks(output.read_text()) == full
+    b.write_text(b.read_text() + "\n")
+    main(fps=[a, b], output=output, cfg=cfg)
+    assert clone_blocks(output.read_text()) == full
+
+    # skipped functions decide which sequences exist, an index of other prefixes is not reused
+    def matches(func_prefixes):
+        index = CloneIndex(tmp_path / "index.db", readonly=True, func_prefixes=func_prefixes)
+        try:
+            return index.matches(cfg)
+        finally:
+            index.close()
+
+    assert matches([]) and not matches(["test_"])
+    main(fps=[a, b], output=output, func_prefixes=["test_"], cfg=cfg)
+    assert matches(["test_"]) and not matches([])
+
+
+def test_shard_merge(tmp_path):
+    a, b = tmp_path / "a.py", tmp_path / "b.py"
+    a.write_text(Path("tests/test_me.py").read_text())
+    b.write_text(a.read_text())  # every clone of a is also a clone across shards
+    fps = [a, b, Path("tests/test_issue6.py")]
+    cfg = Settings(output_format="jsonl")
+
+    def clones(output):
+        records = [json.loads(e) for e in output.read_text().splitlines()]
+        return sorted(sorted(map(json.dumps, e["fragments"])) for e in records)
+
+    main(fps=fps, output=tmp_path / "all.jsonl", cfg=cfg)
+    for n, shard in enumerate([fps[:1], fps[1:]]):
+        shard_cfg = Settings(shard_index=str(tmp_path / f"{n}.db"))
+        main(fps=shard, output=tmp_path / "unused.html", cfg=shard_cfg)
+    assert not (tmp_path / "unused.html").exists()
+    merge_cfg = Settings(output_format="jsonl", merge=True)
+    main(fps=[tmp_path / "0.db", tmp_path / "1.db"], output=tmp_path / "merged.jsonl", cfg=merge_cfg)
+    merged = clones(tmp_path / "merged.jsonl")
+    assert merged == clones(tmp_path / "all.jsonl")
+    assert any({json.loads(e)["file"] for e in clone} == {str(a), str(b)} for clone in merged)
+
+
+def test_server(tmp_path):
+    a, b, c = tmp_path / "a.py", tmp_path / "b.py", tmp_path / "c.py"
+    a.write_text(Path("tests/test_me.py").read_text())
+    b.write_text(Path("tests/test_issue6.py").read_text())
+    cfg = Settings(output_format="jsonl")
+
+    def clones(records):
+        return sorted(sorted(map(json.dumps, e["fragments"])) for e in records)
+
+    def scanned():
+        main(fps=sorted(tmp_path.glob("*.py")), output=tmp_path / "all.jsonl", cfg=cfg)
+        return clones(json.loads(e) for e in (tmp_path / "all.jsonl").read_text().splitlines())
+
+    server = CloneServer([], cfg)
+    server.load([a, b])
+    assert clones(server.clones_involving([str(tmp_path)])) == scanned()
+    c.write_text(a.read_text())
+    b.unlink()
+    result = server.update([str(tmp_path)])
+    assert result["parsed"] == [str(c)] and result["removed"] == [str(b)]
+    assert clones(server.clones_involving([str(tmp_path)])) == scanned()
+    assert any(len(e["fragments"]) == 2 for e in server.clones_involving([str(c)]))
+    stats = server.stats(str(tmp_path))
+    assert stats["files"] == 2 and 0 < stats["covered_lines"] <= stats["source_lines"]
+    # edits leave ids of old versions in the table until it is compacted
+    server.min_canonical_ids = 0
+    server.compact_canonical_ids()
+    live_ids = canonical_id_count()
+    for n in range(5):
+        c.write_text(a.read_text() + f"\n\ndef edit_{n}(x):\n    return x * {n} + 0.{n}\n")
+        server.update([str(c)])
+        assert canonical_id_count() <= server.compact_canonical_ids_at <= 3 * live_ids
+    c.write_text(a.read_text())
+    server.update([str(c)])
+    assert clones(server.clones_involving([str(tmp_path)])) == scanned()
+
+    socket_path = tmp_path / "server.sock"
+    thread = threading.Thread(target=serve, args=(server, socket_path, 1))
+    thread.start()
+    for _ in range(100):
+        if socket_path.exists():
+            break
+        time.sleep(0.05)
+    assert request(socket_path, dict(op="stats", paths=[str(tmp_path)]))["stats"] == {
+        str(tmp_path): stats
+    }
+    assert "error" in request(socket_path, dict(op="unknown"))
+    # an idle client does not hold up others, and is dropped after the timeout
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as idle:
+        idle.connect(str(socket_path))
+        results = []
+        clients = [
+            threading.Thread(target=lambda: results.append(request(socket_path, {"op": "status"})))
+            for _ in range(2)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join(timeout=5)
+        assert len(results) == 2 and all("error" not in e for e in results)
+        idle.settimeout(5)
+        assert idle.recv(1) == b""
+    assert request(socket_path, dict(op="shutdown"))["stopped"]
+    thread.join()
+    assert not socket_path.exists()
+
+
+def test_file_discovery(tmp_path):
+    for name in [
+        "a.py",
+        "notes.txt",
+        "pkg/b.py",
+        "pkg/b_test.py",
+        "pkg/build/c.py",
+        "build/d.py",
+        ".git/e.py",
+        "node_modules/f.py",
+        "env/lib/g.py",
+        "env/pyvenv.cfg",
+    ]:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("")
+
+    def found(*patterns, **kwargs):
+        excludes = ExcludePatterns(DEFAULT_EXCLUDES + list(patterns))
+        paths = FileFinder(excludes, **kwargs).find([tmp_path])
+        return [e.relative_to(tmp_path).as_posix() for e in paths]
+
+    assert found() == ["a.py", "build/d.py", "pkg/b.py", "pkg/b_test.py", "pkg/build/c.py"]
+    assert found("build/", "*_test.py") == ["a.py", "pkg/b.py"]
+    assert found("/build/") == ["a.py", "pkg/b.py", "pkg/b_test.py", "pkg/build/c.py"]
+    assert found("**/build/**", "*.py", "!pkg/b.py") == ["pkg/b.py"]
+    assert found("!node_modules/", "[!f].py") == ["node_modules/f.py", "pkg/b_test.py"]
+    assert found(recursive=False) == ["a.py"]
+    (tmp_path / "list.txt").write_text(f"{tmp_path / 'a.py'}\n\n{tmp_path / 'pkg'}\n")
+    listed = FileFinder().find(read_file_list(tmp_path / "list.txt"))
+    assert [e.name for e in listed] == ["a.py", "b.py", "b_test.py", "c.py"]
+
+
+def test_startup_imports():
+    # importing the entry point does not run it, and a run on a few files with the
+    # default settings imports neither the report engine nor the process pool
+    code = "import sys, clonedigger.__main__, clonedigger.main; print(' '.join(sys.modules))"
+    run = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    modules = set(run.stdout.split())
+    assert not modules & {"pydantic", "jinja2", "sqlite3", "concurrent.futures.process"}
+    cfg = Settings(jobs=2)
+    assert dict(cfg) == cfg.model_dump() and cfg.model_dump()["jobs"] == 2
+    assert Settings(**cfg.model_dump()) == cfg
+
+
+def test_compact_trees(tmp_path):
+    fps = [Path("tests/test_me.py"), Path("tests/test_issue6.py")]
+    reports = []
+    for compact_trees in (False, True):
+        output = tmp_path / "output.html"
+        main(fps=fps, output=output, cfg=Settings(compact_trees=compact_trees))
+        reports.append(output.read_text().split("Clone #", 1)[1])
+    assert reports[0] == reports[1]
+
+
+def test_sorted_runs(tmp_path):
+    records = [(random.randrange(-(2**40), 2**40), i) for i in range(100)]
+    runs = SortedRuns(tmp_path, "<qi", buffer_size=7)
+    for record in records:
+        runs.add(record)
+    assert len(runs.runs) == 14 and len(runs) == 100
+    assert list(runs.merged()) == sorted(records)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_out_of_core(tmp_path):
+    fps = [Path("tests/test_me.py"), Path("tests/test_issue6.py")]
+    reports = []
+    for memory_limit in (0, 1):
+        output = tmp_path / f"output_{memory_limit}.html"
+        main(fps=fps, output=output, cfg=Settings(memory_limit=memory_limit))
+        reports.append(output.read_text().split("Clone #", 1)[1])
+    assert reports[0] == reports[1]
+    lines = LineStore(tmp_path / "lines")
+    assert lines.add({3, 1}) == 0
+    assert list(lines.get(0)) == [1, 3]
+    assert lines.add([2]) == 1  # appended after a read
+    assert list(lines.get(1)) == [2] and list(lines.get(0)) == [1, 3]
+    lines.close()
+    tree = CompactTree.from_ast(ast.parse("x = f(1)\ny = f(1, 2)\nx = f(1)\n"))
+    digests = structure_digests(tree)
+    statements = [digests[i] for i in range(len(tree)) if tree.is_statement[i]]
+    assert statements[0] == statements[2] != statements[1]
+
+
+def test_canonical_ids(tmp_path):
+    source = "def f(a):\n    return a + 1\n\n\ndef g(b):\n    return b + 2.0\n"
+    roots = []
+    for compact in (False, True):
+        path = tmp_path / f"m{compact}.py"
+        path.write_text(source)
+        roots.append(ASTWrapper(path, compact=compact)._tree)
+    for root in roots:
+        f, g = root.childs
+        assert f.getCanonicalId() != g.getCanonicalId()
+        assert f.childs[1].getCanonicalId() == g.childs[1].getCanonicalId()
+    assert roots[0].getCanonicalId() == roots[1].getCanonicalId()
+    assert roots[0] == roots[1]
+
+
+def test_canonical_ids_per_run(tmp_path):
+    cfg = Settings()
+    source_files = parse_files([Path("tests/test_me.py"), Path("tests/test_issue6.py")], [], cfg=cfg)
+    results = []
+    for _ in range(2):
+        # the same trees in a second run get ids from the new table
+        result = clone_detection_algorithm.main(source_files, cfg)
+        clones = [(e.distance, [sorted(s.getCoveredLineNumbers()) for s in e]) for e in result["clones"]]
+        results.append((clones, canonical_id_count()))
+    assert results[0] == results[1]
+    main(fps=[Path("tests/test_me.py")], output=tmp_path / "output.html")
+    assert canonical_id_count() < results[0][1]
+
+
+def test_suffix_array_maximal_pairs():
+    rng = random.Random(0)
+    for _ in range(200):
+        sequences = [
+            [(k, i, rng.randrange(1, 4)) for i in range(rng.randint(1, 12))] for k in range(3)
+        ]
+        threshold = rng.randint(1, 4)
+        suffix_array = SuffixArray(lambda e: e[2])
+        for sequence in sequences:
+            suffix_array.add(sequence)
+        found = sorted(
+            (a[0][:2], b[0][:2], len(a))
+            for a, b in suffix_array.getBestMaxSubstrings(threshold, lambda code: 1)
+        )
+        positions = [(k, i) for k, sequence in enumerate(sequences) for i in range(len(sequence))]
+
+        def code(k, i):
+            if 0 <= i < len(sequences[k]):
+                return sequences[k][i][2]
+            return (k, i)  # never equal to another position
+
+        expected = []
+        for x, (k1, i1) in enumerate(positions):
+            for k2, i2 in positions[:x]:
+                length = 0
+                while code(k1, i1 + length) == code(k2, i2 + length):
+                    length += 1
+                left = code(k1, i1 - 1)
+                if length >= threshold and (i1 == 0 or i2 == 0 or left != code(k2, i2 - 1)):
+                    expected.append(((k1, i1), (k2, i2), length))
+        assert sorted(
+            tuple(sorted(e[:2], reverse=True)) + e[2:] for e in found
+        ) == sorted(expected)
+
+
+def test_unification_cache(tmp_path):
+    path = tmp_path / "m.py"
+    path.write_text("a = f(1)\nb = g(x, 2)\nc = f(1)\nd = g(y, [3])\n")
+    cfg = Settings(size_threshold=1)
+    source_file = ASTWrapper(path)
+    source_file.fingerprint(cfg)
+    (sequence,) = source_file.statement_sequences
+    pair = PairSequences([StatementSequence(sequence[:2]), StatementSequence(sequence[2:])], cfg=cfg)
+    trees = [s.constructTree() for s in pair]
+    unification_cache.clear()
+    assert pair.calcDistance() == Unifier(trees[0], trees[1], cfg=cfg).getSize() > 0
+    assert (unification_cache.hits, unification_cache.misses) == (0, 2)
+    pair.calcDistance()
+    assert (unification_cache.hits, unification_cache.misses) == (2, 2)
+
+
+def test_bounded_unification():
+    cfg = Settings()
+    source_file = ASTWrapper(Path("tests/test_issue6.py"))
+    source_file.fingerprint(cfg)
+    statements = [s for sequence in source_file.statement_sequences for s in sequence]
+    unification_cache.clear(0)
+    for t1 in statements:
+        for t2 in statements:
+            cost = Unifier(t1, t2, cfg=cfg).getSize()
+            assert unification_cache.getCost(t1, t2, cfg) == cost
+            if cost > 0:
+                assert unification_cache.getCost(t1, t2, cfg, limit=cost / 2) == math.inf
+
+
+def test_refine_table():
+    cfg = Settings()
+    source_file = ASTWrapper(Path("tests/test_issue6.py"))
+    source_file.fingerprint(cfg)
+    sequence = max(source_file.statement_sequences, key=len)
+    pair = PairSequences([sequence, StatementSequence(list(reversed(sequence)))], cfg)
+    table = RefineTable(pair, cfg)
+    for first in range(len(pair)):
+        for n in range(1, len(pair) - first + 1):
+            window = pair.subSequence(first, n)
+            distance = window.calcDistance()
+            assert table.getMaxCoveredLineNumbersCount(first, n) == window.getMaxCoveredLineNumbersCount()
+            for limit in (distance, distance + 0.5):
+                assert table.isDistanceBelow(first, n, limit) == (distance < limit)
+
+
+def test_line_coverage():
+    cfg = Settings()
+    source_files = parse_files([Path("tests/test_issue6.py"), Path("tests/test_me.py")], [], cfg=cfg)
+    sequences = [s for source_file in source_files for s in source_file.statement_sequences]
+    coverage = LineCoverage()
+    expected = set()
+    for sequence in sequences[::2]:
+        coverage.add(sequence)
+        expected |= sequence.getLineNumberHashables()
+    total = LineCoverage()
+    for sequence in sequences:
+        total.add(sequence)
+    assert len(coverage) == len(expected)
+    files, directories = coverage.percentages(total)
+    assert set(files) == {"tests/test_issue6.py", "tests/test_me.py"}
+    assert directories == {"tests": 100 * len(coverage) / len(total)}
+    # a directory counts the files of its subdirectories too
+    coverage = LineCoverage()
+    coverage.counts = lambda: {"src/a.py": 10, "src/pkg/sub/c.py": 5}
+    files, directories = coverage.percentages_of(
+        {"src/a.py": 10, "src/pkg/b.py": 10, "src/pkg/sub/c.py": 20, "src/empty.py": 0}
+    )
+    assert files == {"src/a.py": 100, "src/pkg/b.py": 0, "src/pkg/sub/c.py": 25}
+    assert directories == {"src": 37.5, "src/pkg": 100 * 5 / 30, "src/pkg/sub": 25}
+
+
+def test_clones_carry_distances():
+    cfg = Settings()
+    source_files = parse_files([Path("tests/test_me.py")], [], cfg=cfg)
+    clones = clone_detection_algorithm.main(source_files, cfg)["clones"]
+    assert clones
+    for clone in clones:
+        assert clone.distance == clone.calcDistance()
+        assert clone.row_differences == [
+            Unifier(t1, t2, cfg=cfg).getSize() > 0 for t1, t2 in zip(clone[0], clone[1])
+        ]
+
+
+def test_small_candidates_excluded(tmp_path):
+    # statements with equal marks cover 1 or 4 lines, marks alone overestimate a repeat
+    body = "    x = f(1, 2)\n    y = g(3, 4)\n"
+    wide = "    x = f(\n        1,\n        2,\n    )\n    y = g(\n        3,\n        4,\n    )\n"
+    fp = tmp_path / "small.py"
+    fp.write_text(
+        f"def a():\n{body}    for i in p:\n        q(i)\n    return 1\n\n\n"
+        f"def b():\n{body}    while p:\n        q()\n    del z\n\n\n"
+        f"def c():\n{wide}    with p:\n        q()\n"
+    )
+    for memory_limit in (0, 1):
+        cfg = Settings(distance_threshold=-1, clusterize_using_hash=True, memory_limit=memory_limit)
+        result = find_clones([fp], [], cfg, Instrumentation())
+        sizes = [[len(e.getCoveredLineNumbers()) for e in clone] for clone in result["clones"]]
+        assert sizes == [[8, 2], [8, 2]]  # not the first two lines of a and b
+
+
+def shape(tree, first_variable):
+    if isinstance(tree, FreeVariable):
+        return f"VAR({int(tree.name[4:-1]) - first_variable})"
+    return f"{tree.name}({','.join(shape(c, first_variable) for c in tree.childs)})"
+
+
+def test_parallel_patterns_are_deterministic():
+    fps = [Path("tests/test_me.py"), Path("tests/test_issue6.py")]
+    marks = []
+    for jobs in (1, 2):
+        cfg = Settings(jobs=jobs, clusterize_using_dcup=False, size_threshold=1)
+        source_files = parse_files(fps, [], cfg=cfg)
+        first_cluster = Cluster.count
+        first_variable = FreeVariable.count
+        clone_detection_algorithm.main(source_files, cfg)
+        marks.append(
+            [
+                (
+                    statement.mark._cluster_number - first_cluster,
+                    len(statement.mark),
+                    statement.mark.max_covered_lines,
+                    shape(statement.mark.pattern, first_variable),
+                )
+                for source_file in source_files
+                for sequence in source_file.statement_sequences
+                for statement in sequence
+            ]
+        )
+    assert marks[0] == marks[1]
+
+
+def test_cluster_index(tmp_path):
+    path = tmp_path / "m.py"
+    path.write_text("a = f(x, y)\nb = f(z, y)\nwith c:\n    del d[e:g]\n")
+    source_file = ASTWrapper(path)
+    first, second, third = source_file._tree.childs
+    index = ClusterIndex()
+    index.add("first", first)
+    index.add("third", third)
+    assert index.candidates(second) == ["first"]
+    assert index.candidates(second, extra=["third"]) == ["first", "third"]
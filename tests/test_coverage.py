@@ -1,13 +1,9 @@
+from pathlib import Path
 from clonedigger.main import main
-import os
 
-os.chdir("..")
 
-
-def test_1():
-    # main('tests/test_me.py')
-    # todo: why does it report a list?
-    main("../wealth-pct-main-api/run_flask.py")
-
-
-test_1()
+def test_1(tmp_path):
+    # clonedigger's own sources, a real project that is always at hand
+    output = tmp_path / "output.html"
+    main(sorted(Path("src").rglob("*.py")), output)
+    assert "Clones detected" in output.read_text()